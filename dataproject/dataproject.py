@@ -1,23 +1,297 @@
+import copy
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from types import SimpleNamespace
+from urllib.parse import urlencode, urlsplit
 import pandas as pd
-from dstapi import DstApi
 import matplotlib.pyplot as plt
 import seaborn as sns
 
 
+## FETCHING FROM STATISTIK BANKEN ##
+#Address of the Statistik Banken API, the same one DstApi uses
+DST_API_URL = 'https://api.statbank.dk/v1'
+
+#Folder for the cached API responses
+DST_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__dstcache__')
+
+
+#Fetches tables from Statistik Banken like DstApi, but can fetch several tables at once on a thread pool kept by
+#the fetcher, where each thread reuses its own connection. Responses are stored on disk and reused until they are
+#older than ttl seconds. base_url can point at a local server, so the loaders can be run without the real API.
+#close() (or a with block) shuts down the threads and closes the connections
+class DstFetcher:
+    def __init__(self, base_url=DST_API_URL, cache_dir=None, ttl=24 * 3600, max_workers=4, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.cache_dir = DST_CACHE_DIR if cache_dir is None else cache_dir
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        url = urlsplit(self.base_url)
+        self._scheme, self._host, self._path = url.scheme, url.netloc, url.path
+        self._local = threading.local()
+        self._connections = [] #every open connection, so close() can reach those of the pool threads
+        self._executor = None #thread pool, started the first time several requests are sent
+
+        #number of requests sent to the API and answered from the cache
+        self.requests = 0
+        self.cache_hits = 0
+        self._lock = threading.Lock()
+
+    #Open connection of this thread, kept alive between requests
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            Connection = http.client.HTTPSConnection if self._scheme == 'https' else http.client.HTTPConnection
+            conn = self._local.conn = Connection(self._host, timeout=self.timeout)
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    #Drop the connection of this thread, the next request opens a new one
+    def _drop_connection(self, conn):
+        conn.close()
+        self._local.conn = None
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+
+    #Thread pool of the fetcher, reused by fetch_many and base_params_many so the threads keep their connections
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    #Shut down the thread pool and close all connections
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #Send one request and return the body as text. If the server has closed the kept-alive connection, reconnect once.
+    #After any other error the connection is dropped before the error is raised, so it is not reused in a broken state
+    def _request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, self._path + path, body=body, headers=headers)
+                response = conn.getresponse()
+                text = response.read().decode('utf-8')
+                break
+            except (http.client.RemoteDisconnected, ConnectionError):
+                self._drop_connection(conn)
+                if attempt == 1:
+                    raise
+            except Exception:
+                self._drop_connection(conn)
+                raise
+
+        with self._lock:
+            self.requests += 1
+        if response.status >= 400:
+            raise RuntimeError(f"Statistik Banken returned {response.status} for {path}: {text[:200]}")
+        return text
+
+    #Return the cached text for (kind, payload) if it is younger than ttl, otherwise call fetch and store the result
+    def _cached(self, kind, payload, fetch):
+        key = hashlib.sha256(json.dumps([kind, payload], sort_keys=True).encode()).hexdigest()[:16]
+        path = os.path.join(self.cache_dir, f'{kind}_{key}.txt')
+
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < self.ttl:
+            with self._lock:
+                self.cache_hits += 1
+            with open(path, encoding='utf-8') as file:
+                return file.read()
+
+        text = fetch()
+
+        #write to a temporary file first, so other threads or sessions never read half a file
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(tmp, path)
+        return text
+
+    #Description of the table and its variables, like DstApi.tablesummary
+    def tableinfo(self, table, language='en'):
+        query = {'id': table.lower(), 'format': 'JSON', 'lang': language}
+        text = self._cached('tableinfo', query, lambda: self._request('GET', '/tableinfo?' + urlencode(query)))
+        return json.loads(text)
+
+    #Template selecting all data in the table, like DstApi._define_base_params
+    def base_params(self, table, language='en'):
+        info = self.tableinfo(table, language)
+        variables = [{'code': var['id'], 'values': ['*']} for var in info['variables']]
+        return {'table': table.lower(), 'format': 'BULK', 'lang': language, 'variables': variables}
+
+    #Get the data selected by params as a DataFrame, like DstApi.get_data
+    def get_data(self, params):
+        text = self._cached('data', params, lambda: self._request('POST', '/data', body=json.dumps(params)))
+        return pd.read_table(StringIO(text), sep=';')
+
+    #Get several tables at once. params is a dict of name: params, and a dict of name: DataFrame is returned.
+    #Identical requests are only sent once
+    def fetch_many(self, params):
+        unique = {}
+        for name, p in params.items():
+            unique.setdefault(json.dumps(p, sort_keys=True), p)
+
+        frames = dict(zip(unique, self._pool().map(self.get_data, unique.values())))
+
+        return {name: frames[json.dumps(p, sort_keys=True)].copy() for name, p in params.items()}
+
+    #Get the base params of several tables at once
+    def base_params_many(self, tables, language='en'):
+        return dict(zip(tables, self._pool().map(lambda table: self.base_params(table, language), tables)))
+
+
+## CACHE OF THE CLEANED TABLES ##
+#Folder for the cleaned tables
+TABLE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__tablecache__')
+
+#Columns with few distinct values, stored as categorical
+CATEGORICAL_COLUMNS = ['municipality', 'Country']
+
+
+#Load the cleaned table name from the cache, or build it and store it. key is what the table is derived from,
+#the API params or the hash of the source file, so a new selection or a changed file gives a new entry.
+#The table is stored as Parquet if pyarrow is installed and as a pickle otherwise. Entries older than ttl seconds are rebuilt.
+#The tables from Statistik Banken are stored in the cache folder of the fetcher, next to the responses they are made from
+def cached_table(name, key, build, cache=True, ttl=None, cache_dir=None):
+    cache_dir = TABLE_CACHE_DIR if cache_dir is None else cache_dir
+    if not cache:
+        return _categorize(build())
+
+    try:
+        import pyarrow
+        ext = 'parquet'
+    except ImportError:
+        ext = 'pkl'
+
+    digest = hashlib.sha256(json.dumps([name, key], sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f'{name}_{digest}.{ext}')
+
+    if os.path.exists(path) and (ttl is None or time.time() - os.path.getmtime(path) < ttl):
+        return pd.read_parquet(path) if ext == 'parquet' else pd.read_pickle(path)
+
+    table = _categorize(build())
+
+    #write to a temporary file first, so a half written table is never read
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    if ext == 'parquet':
+        table.to_parquet(tmp)
+    else:
+        table.to_pickle(tmp)
+    os.replace(tmp, path)
+    return table
+
+
+#Store the municipality and country columns as categorical, which takes much less memory than strings
+def _categorize(table):
+    for col in CATEGORICAL_COLUMNS:
+        if col in table.columns:
+            table[col] = table[col].astype('category')
+    return table
+
+
+#Hash of the contents of a file, used as cache key for the CSV tables
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+#Fetcher used by the loaders when none is given
+_fetcher = None
+
+def default_fetcher():
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = DstFetcher()
+    return _fetcher
+
+
+#Load all the Statistik Banken tables used in the notebook at once. The cleaned tables are shared with the
+#single loaders through the table cache, and only if one is missing are the tables fetched. HFUDD11 is then
+#fetched once and split into the data for HFUD11_data and population_data
+def load_tables(fetcher=None, cache=True):
+    fetcher = default_fetcher() if fetcher is None else fetcher
+    base = fetcher.base_params_many(['HFUDD11', 'FOD407', 'FOLK1A'])
+
+    #params of the single loaders, which are also the cache keys
+    params = {'HFUD11': HFUD11_params(copy.deepcopy(base['HFUDD11'])),
+              'FOD407': FOD407_params(base['FOD407']),
+              'population': population_params(copy.deepcopy(base['HFUDD11'])),
+              'FOLK1A': FOLK1A_params(base['FOLK1A'])}
+
+    #Fetch and clean all tables the first time one of them is not in the cache
+    fetched = {}
+    def build(name):
+        if not fetched:
+            fetched.update(_fetch_tables(fetcher, params))
+        return fetched[name]
+
+    tables = {name: cached_table(name, p, lambda name=name: build(name), cache, fetcher.ttl, fetcher.cache_dir) for name, p in params.items()}
+    return SimpleNamespace(ind=tables['HFUD11'], fert=tables['FOD407'], pop=tables['population'], totpop=tables['FOLK1A'])
+
+
+#Fetch the tables for load_tables concurrently and clean them
+def _fetch_tables(fetcher, params):
+    #One HFUDD11 request with both the higher educated and the total population
+    hfudd = copy.deepcopy(params['HFUD11'])
+    hfudd['variables'][2]['values'] = ['H70', 'TOT']
+
+    frames = fetcher.fetch_many({'HFUDD11': hfudd, 'FOD407': params['FOD407'], 'FOLK1A': params['FOLK1A']})
+
+    #The bulk format uses the labels of the values, which are found in the table info
+    labels = {var['id']: {value['id']: value['text'] for value in var['values']}
+              for var in fetcher.tableinfo('HFUDD11')['variables']}
+    both = frames['HFUDD11']
+    ind_raw = both[both['HFUDD'] == labels['HFUDD']['H70']]
+    pop_raw = both[(both['HFUDD'] == labels['HFUDD']['TOT']) & both['BOPOMR'].isin([labels['BOPOMR'][code] for code in POPULATION_AREAS])]
+
+    return {'HFUD11': HFUD11_clean(ind_raw.copy()),
+            'FOD407': FOD407_clean(frames['FOD407']),
+            'population': population_clean(pop_raw.copy()),
+            'FOLK1A': FOLK1A_clean(frames['FOLK1A'])}
+
+
 
 #define the table for HFUD11 below 
-def HFUD11_data():
+def HFUD11_data(fetcher=None, cache=True):
     # a. Load the data from Statistik Banken
-    ind = DstApi('HFUDD11') 
-
-    #Set the language to english
-    tabsum = ind.tablesummary(language='en')
+    fetcher = default_fetcher() if fetcher is None else fetcher
+    params = HFUD11_params(fetcher.base_params('HFUDD11'))
 
+    #Use the variables set above
+    return cached_table('HFUD11', params, lambda: HFUD11_clean(fetcher.get_data(params)), cache, fetcher.ttl, fetcher.cache_dir)
 
-    # The _define_base_params -method gives us a nice template (selects all available data)
-    params = ind._define_base_params(language='en')
-    params
 
+#Select the data for HFUD11 in the template params, which selects all available data
+def HFUD11_params(params):
     variables = params['variables'] # Returns a view, that we can edit
     # b. We are initially looking at all municipalities, why we don't write anything for the first variable
     
@@ -30,14 +304,13 @@ def HFUD11_data():
     #We are only looking at people with the gender male and female
     variables[4]['values'] = ["TOT"]
     #We don't write anything for variables[5], and therefore, we are looking at people across all dates from 2008 to 2023.
-    params
+    return params
 
-    #Use the variables set above
-    ind_api = ind.get_data(params=params)
 
+#Clean the data for HFUD11
+def HFUD11_clean(ind_api):
     # c. Sort values for BOPOMR, HFDD, KØN and TID
     ind_api.sort_values(by=['BOPOMR', 'HFUDD', "KØN", "TID"], inplace=True)
-    ind_api.head(5)
 
     # d. drop the columns "HERKOMST"
     for v in ['HERKOMST']: 
@@ -68,32 +341,30 @@ def HFUD11_data():
 
 #Define the table for FOD407
 
-def FOD407_data():
+def FOD407_data(fetcher=None, cache=True):
     # a. Load the data from Statistik Banken
-    fert = DstApi("FOD407")
+    fetcher = default_fetcher() if fetcher is None else fetcher
+    params = FOD407_params(fetcher.base_params('FOD407'))
 
-    #Set the language to english
-    tabsum = fert.tablesummary(language='en')
+    #Use the variables set above
+    return cached_table('FOD407', params, lambda: FOD407_clean(fetcher.get_data(params)), cache, fetcher.ttl, fetcher.cache_dir)
 
-    # The _define_base_params -method gives us a nice template (selects all available data)
-    params = fert._define_base_params(language='en')
-    params  
 
+#Select the data for FOD407 in the template params
+def FOD407_params(params):
     variables = params["variables"]
     # b. We are initially looking at all municipalities, why we dont write anything for the first variable
     
     #We are looking at total fertility rate
     variables[1]["values"] = ["TOT1"]
     #We are looking across all time, therefore we don't write anything to time. 
-    params
+    return params
 
 
-    #Use the variables set above
-    fert_api = fert.get_data(params=params)
-
+#Clean the data for FOD407
+def FOD407_clean(fert_api):
     # c. Sort values for BOPOMR, HFDD, KØN and TID
     fert_api.sort_values(by=['OMRÅDE', 'ALDER', "TID"], inplace=True)
-    fert_api.head(5)
 
     # d. Drop the coloumns "ALDER"
     for v in ['ALDER']: 
@@ -121,22 +392,24 @@ def FOD407_data():
 
 #Define a table for total populaiton in each area
 
-def population_data():
+#We are only looking at people from Copenhagen, Thisted and Aalborg
+POPULATION_AREAS = ["101", "787", "851"]
+
+def population_data(fetcher=None, cache=True):
     
     #Load the data from Statistik Banken
-    pop = DstApi('HFUDD11') 
-
-    #Set the language to english
-    tabsum = pop.tablesummary(language='en')
+    fetcher = default_fetcher() if fetcher is None else fetcher
+    params = population_params(fetcher.base_params('HFUDD11'))
 
+    #Use the variables set above
+    return cached_table('population', params, lambda: population_clean(fetcher.get_data(params)), cache, fetcher.ttl, fetcher.cache_dir)
 
-    # The _define_base_params -method gives us a nice template (selects all available data)
-    params = pop._define_base_params(language='en')
-    params
 
+#Select the data for the total population in the template params
+def population_params(params):
     variables = params['variables'] # Returns a view, that we can edit
     #We are only looking at people from Copenhagen, Thisted and Aalborg
-    variables[0]["values"] = ["101","787", "851"]
+    variables[0]["values"] = list(POPULATION_AREAS)
     #We are looking at people across all "Herkomst"
     variables[1]["values"] = ["TOT"]
     #We are looking at everyone, no matter the the education.
@@ -146,14 +419,13 @@ def population_data():
     #We are only looking at people with the gender male and female
     variables[4]['values'] = ["TOT"]
     #We don't write anything for variables[5], and therefore, we are looking at people across all dates from 2008 to 2023.
-    params
+    return params
 
-    #Use the variables set above
-    pop_api = pop.get_data(params=params)
 
+#Clean the data for the total population
+def population_clean(pop_api):
     #Sort values for BOPOMR, HFDD, KØN and TID
     pop_api.sort_values(by=['BOPOMR', 'HFUDD', "KØN", "TID"], inplace=True)
-    pop_api.head(5)
 
     # d. drop the columns "HERKOMST"
     for v in ['HERKOMST']: 
@@ -343,19 +615,18 @@ def plot_fer_BA(municipality, ind_api, fert_api):
 
 
 #Total populations to define urban and rural areas
-def FOLK1A_data():
+def FOLK1A_data(fetcher=None, cache=True):
     
     #Load the data from Statistik Banken
-    totpop = DstApi('FOLK1A') 
-
-    #Set the language to english
-    tabsum = totpop.tablesummary(language='en')
+    fetcher = default_fetcher() if fetcher is None else fetcher
+    params = FOLK1A_params(fetcher.base_params('FOLK1A'))
 
+    #Use the variables set above
+    return cached_table('FOLK1A', params, lambda: FOLK1A_clean(fetcher.get_data(params)), cache, fetcher.ttl, fetcher.cache_dir)
 
-    # The _define_base_params -method gives us a nice template (selects all available data)
-    params = totpop._define_base_params(language='en')
-    params
 
+#Select the data for FOLK1A in the template params
+def FOLK1A_params(params):
     variables = params['variables'] # Returns a view, that we can edit
     #We are looking at all municipalities, why we dont write anything for the first variable
     #We are looking at all genders"
@@ -366,15 +637,13 @@ def FOLK1A_data():
     variables[3]["values"] = ["TOT"]
     #We are looking at data for the end of each quarter of years 2008-2023. 
     variables[4]["values"] = ['2008K4', '2009K4', '2010K4', '2011K4', '2012K4', '2013K4', '2014K4', '2015K4', '2016K4', '2017K4', '2018K4', '2019K4', '2020K4', '2021K4', '2022K4', '2023K4']
-                              
-    params
+    return params
 
-    #Use the variables set above
-    totpop_api = totpop.get_data(params=params)
 
+#Clean the data for FOLK1A
+def FOLK1A_clean(totpop_api):
     #Sort values
     totpop_api.sort_values(by=["OMRÅDE", "KØN", "ALDER", "CIVILSTAND", "TID"], inplace=True)
-    totpop_api.head(5)
  
     #rename the columns
     totpop_api = totpop_api.rename(columns = {"INDHOLD":"totalpop", "OMRÅDE": "municipality", "KØN":"gender", "ALDER": "age", "CIVILSTAND":"all", "TID" :"year"})
@@ -397,7 +666,12 @@ def FOLK1A_data():
 
 ## CSV IMPORT OF EUROSTAT DATA ##
 #Importing data for education levels from the CSV with data from eurostat
-def educ_c():
+def educ_c(path='sdg_04_20_page_linear.csv', cache=True):
+    return cached_table('educ', file_hash(path), lambda: educ_clean(path), cache)
+
+
+#Clean the education data
+def educ_clean(path):
     #Rename the country codes so they match that of the World Bank Data
     country_mapping = {
         "BE": "BEL", "BG": "BGR", "HR": "HRV", "CY": "CYP", "DK": "DNK", "CZ": "CZE", "EE": "EST", "FR": "FRA", "FI": "FIN",
@@ -407,7 +681,7 @@ def educ_c():
     }
     #Read the data from the CSV file and replace the 'geo' labels with the newly named ones
 
-    educ = pd.read_csv('sdg_04_20_page_linear.csv')
+    educ = pd.read_csv(path)
     educ['geo'] = educ['geo'].replace(country_mapping)
 
     # columns to remove (columns 1-7 and column 11) since they are not needed
@@ -432,9 +706,14 @@ def educ_c():
 
 
 #Importing fertility data from the CSV with data from the World Bank Indicators
-def fert():
+def fert(path='Fert_Data.csv', cache=True):
+    return cached_table('fert', file_hash(path), lambda: fert_clean(path), cache)
+
+
+#Clean the fertility data
+def fert_clean(path):
 
-    fert = pd.read_csv('Fert_Data.csv')
+    fert = pd.read_csv(path)
 
     # These columns have to go: 'Country Name' 'Time Code', and bottom rows should be deleted
     drop_these = (['Country Name'] + ['Time Code']) 
@@ -1,6 +1,12 @@
 from types import SimpleNamespace
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import copy
+import time
+import os
 import numpy as np
-from scipy.optimize import minimize
+import pandas as pd
+from scipy.optimize import minimize, minimize_scalar, root
 
 
 
@@ -21,6 +27,17 @@ class ProductionEconomyClass:
         # Question 3
         self.par.kappa = 0.1
         self.par.w = 1
+
+        # Cache of household solutions for scalar prices, with LRU eviction
+        self.cache_size = 1024
+        self.clear_cache()
+
+    # Empty the household cache and reset the counters
+    def clear_cache(self):
+        self._household_cache = OrderedDict()
+        self._cache_par = None
+        self.cache_hits = 0
+        self.cache_misses = 0
     
     # Firm optimal labor demand
     def l_star_firm(self, p):
@@ -49,44 +66,110 @@ class ProductionEconomyClass:
         return (1 - par.alpha) * ((par.w * l + T + self.pi_star_firm(p1) + self.pi_star_firm(p2)) / (p2 + tau))
 
     # Consumer optimal labor behavior
-    def l_star_consumer(self, p1, p2):
-        par = self.par
-        # Objective function to minimize
-        def lstar(l):
-            c1 = self.c13(p1, p2, par.T, l)
-            c2 = self.c23(p1, p2, par.tau, par.T, l)
-            return -(np.log(c1**par.alpha * c2**(1-par.alpha)) - par.nu*l**(1+par.epsilon)/(1+par.epsilon))
-        
-        # Optimize
-        initial_guess = [0.1]
-        bounds = [(0, None)]
-        result = minimize(lstar, initial_guess, bounds=bounds, method='SLSQP')
-        return result.x[0]
+    # With log utility the consumer's problem reduces to max log(w*l + T + pi1 + pi2) - nu*l^(1+epsilon)/(1+epsilon),
+    # so the FOC is nu*l^epsilon*(w*l + T + pi1 + pi2) = w. We solve it with Newton's method in u = log(l), where it is
+    # convex and increasing, so it converges from any start. Works for p1 and p2 as numpy arrays
+    def l_star_consumer(self, p1, p2, tol=1e-12, maxiter=50):
+        par = self.par
+        R = par.T + self.pi_star_firm(p1) + self.pi_star_firm(p2)
+        R = np.asarray(R, dtype=float)
+
+        # Start at the solution without non-labor income, which is to the right of the root
+        u = np.full(R.shape, -np.log(par.nu) / (1 + par.epsilon))
+        for _ in range(maxiter):
+            wl = par.w * np.exp(u)
+            h = np.log(par.nu) + par.epsilon * u + np.log(wl + R) - np.log(par.w)
+            dh = par.epsilon + wl / (wl + R)
+            step = h / dh
+            u = u - step
+            if np.all(np.abs(step) < tol):
+                break
+
+        l = np.exp(u)
+        return l if l.ndim > 0 else float(l)
+
+    # Household solution (labor supply and consumption) at prices p1 and p2, given par.tau and par.T.
+    # Scalar prices are cached, keyed on the prices, tau and T. Changing any other parameter empties the cache
+    def household(self, p1, p2):
+        par = self.par
+
+        # Solve directly for arrays of prices
+        if np.ndim(p1) > 0 or np.ndim(p2) > 0:
+            return self._solve_household(p1, p2)
+
+        # Clear the cache if any parameter other than tau and T has changed since it was filled
+        par_key = tuple(sorted((name, value) for name, value in vars(par).items() if name not in ('tau', 'T')))
+        if par_key != self._cache_par:
+            self._household_cache.clear()
+            self._cache_par = par_key
+
+        key = (float(p1), float(p2), par.tau, par.T)
+        if key in self._household_cache:
+            self.cache_hits += 1
+            self._household_cache.move_to_end(key)
+            return self._household_cache[key]
+
+        self.cache_misses += 1
+        sol = self._household_cache[key] = self._solve_household(p1, p2)
+        if len(self._household_cache) > self.cache_size:
+            self._household_cache.popitem(last=False)
+        return sol
+
+    # Add the cache counters of a copy of the model, or of a result that carries them, to this model.
+    # The solvers work on copies so par is not changed, this keeps the counters of the caller meaningful
+    def _add_cache_counts(self, other):
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+
+    # Solve the household problem, computing firm profits once for both goods
+    def _solve_household(self, p1, p2):
+        par = self.par
+        sol = SimpleNamespace()
+        sol.pi1 = self.pi_star_firm(p1)
+        sol.pi2 = self.pi_star_firm(p2)
+        sol.l = self.l_star_consumer(p1, p2)
+        income = par.w * sol.l + par.T + sol.pi1 + sol.pi2
+        sol.c1 = par.alpha * income / p1
+        sol.c2 = (1 - par.alpha) * income / (p2 + par.tau)
+        return sol
 
     # Market Clearing Condition: Labor market
     def excessdemand_labor(self, p1, p2):
         par = self.par
         l1 = self.l_star_firm(p1)
         l2 = self.l_star_firm(p2)
-        l_opt = self.l_star_consumer(p1, p2)
+        l_opt = self.household(p1, p2).l
         return l1 + l2 - l_opt
 
     #Market Clearing Condition: Good market 1
     def excessdemand_goodmarket1(self, p1, p2):
         par = self.par
-        l_opt = self.l_star_consumer(p1, p2)
-        c1 = self.c13(p1, p2, par.T, l_opt)
+        c1 = self.household(p1, p2).c1
         y1 = self.y_star_firm(p1)
         return c1 - y1
 
     # Market Clearing Condition: Good market 2
     def excessdemand_goodmarket2(self, p1, p2):
         par = self.par
-        l_opt = self.l_star_consumer(p1, p2)
-        c2 = self.c23(p1, p2, par.tau, par.T, l_opt)
+        c2 = self.household(p1, p2).c2
         y2 = self.y_star_firm(p2)
         return c2 - y2
     
+    # Excess demand in all three markets on the grid of p1_values x p2_values, arrays with shape (len(p1), len(p2)).
+    # With chunk_rows the grid is evaluated a block of p1 rows at a time, on a process pool if workers is given
+    def excessdemand_grid(self, p1_values, p2_values, chunk_rows=None, workers=None):
+        p1_values = np.asarray(p1_values, dtype=float)
+        p2_values = np.asarray(p2_values, dtype=float)
+
+        chunk_rows = p1_values.size if chunk_rows is None else chunk_rows
+        chunks = [(self.par, p1_values[i:i + chunk_rows], p2_values) for i in range(0, p1_values.size, chunk_rows)]
+
+        results = list(_run_tasks(_excessdemand_block, chunks, workers))
+
+        grid = SimpleNamespace(p1=p1_values, p2=p2_values)
+        grid.labor, grid.goodmarket1, grid.goodmarket2 = [np.concatenate([r[k] for r in results]) for k in range(3)]
+        return grid
+
     # The objective function for finding equilibrium prices
     def objectiveprice(self, p):
         p1, p2 = p
@@ -94,10 +177,74 @@ class ProductionEconomyClass:
         excess_goodsmarket2 = self.excessdemand_goodmarket2(p1, p2)
         return excess_labor**2 + excess_goodsmarket2**2  # check that labor market clears and good market 2 clears
 
+    # Excess demand in the labor market and good market 2, the two markets checked in objectiveprice
+    def excessdemand(self, p):
+        p1, p2 = p
+        return np.array([self.excessdemand_labor(p1, p2), self.excessdemand_goodmarket2(p1, p2)])
+
+    # Analytic Jacobian of excessdemand with respect to (p1, p2)
+    def excessdemand_jac(self, p):
+        par = self.par
+        p1, p2 = p
+        hh = self.household(p1, p2)
+
+        # Derivatives of firm profits, labor demand and output. All are powers of p
+        dpi1 = hh.pi1 / ((1 - par.gamma) * p1)
+        dpi2 = hh.pi2 / ((1 - par.gamma) * p2)
+        dl1 = self.l_star_firm(p1) / ((1 - par.gamma) * p1)
+        dl2 = self.l_star_firm(p2) / ((1 - par.gamma) * p2)
+        dy2 = par.gamma * self.y_star_firm(p2) / ((1 - par.gamma) * p2)
+
+        # Labor supply responds to non-labor income R = T + pi1 + pi2 through the FOC nu*l^epsilon*(w*l + R) = w
+        income = par.w * hh.l + par.T + hh.pi1 + hh.pi2
+        dl_dR = -hh.l / (par.epsilon * income + par.w * hh.l)
+        dI_dR = par.w * dl_dR + 1
+
+        return np.array([
+            [dl1 - dl_dR * dpi1, dl2 - dl_dR * dpi2],
+            [(1 - par.alpha) * dI_dR * dpi1 / (p2 + par.tau),
+             (1 - par.alpha) * (dI_dR * dpi2 / (p2 + par.tau) - income / (p2 + par.tau)**2) - dy2]
+        ])
+
+    # Solve for the equilibrium prices with a root finder, trying each initial guess.
+    # With workers the guesses run on a process pool. Once one converges the queued guesses are cancelled and
+    # the method returns without waiting for the ones still running
+    def solve_equilibrium(self, initial_guesses=([1, 1], [0.5, 0.5], [1.5, 1.5], [0.1, 0.1], [2.0, 2.0]),
+                          method='hybr', tol=1e-10, workers=None):
+        t0 = time.perf_counter()
+        tasks = [(self.par, guess, method, tol) for guess in initial_guesses]
+
+        best = None
+        if workers is None:
+            for task in tasks:
+                sol = _solve_from_guess(task)
+                self._add_cache_counts(sol)
+                if best is None or sol.residual < best.residual:
+                    best = sol
+                if best.success:
+                    break
+        else:
+            # Not a with block, since leaving it waits for the guesses that are still running
+            executor = ProcessPoolExecutor(max_workers=workers)
+            try:
+                futures = [executor.submit(_solve_from_guess, task) for task in tasks]
+                for future in as_completed(futures):
+                    sol = future.result()
+                    self._add_cache_counts(sol)
+                    if best is None or sol.residual < best.residual:
+                        best = sol
+                    if best.success:
+                        break
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        best.time = time.perf_counter() - t0
+        return best
+
     # Consumer utility function
     def utility_all(self, p1, p2, tau):
         par = self.par
-        l_star = self.l_star_consumer(p1, p2)
+        l_star = self.household(p1, p2).l
         T = tau * self.c23(p1, p2, tau, 0, l_star)
         c1 = self.c13(p1, p2, T, l_star)
         c2 = self.c23(p1, p2, tau, T, l_star)
@@ -127,7 +274,310 @@ class ProductionEconomyClass:
         bounds = [(0, None)]
         constraints = {
             'type': 'eq',
-            'fun': lambda tau: self.budget_constraint(p1, p2, tau, self.l_star_consumer(p1, p2))
+            'fun': lambda tau: self.budget_constraint(p1, p2, tau, self.household(p1, p2).l)
         }
         result = minimize(lambda tau: self.social_welfare(p1, p2, tau), initial_guess, bounds=bounds, constraints=constraints, method='SLSQP')
-        return result.x[0]
\ No newline at end of file
+        return result.x[0]
+
+
+    # General equilibrium given the tax tau, where the government returns the revenue, T = tau*c2.
+    # Solves for (log p1, log p2, T) so prices stay positive. guess is (p1, p2, T)
+    def policy_equilibrium(self, tau, guess=(1.0, 1.0, 0.0), tol=1e-10):
+        # Work on a copy of the model so par is not changed
+        work = _model_with(self.par)
+        work.par.tau = tau
+
+        def equations(x):
+            p1, p2 = np.exp(x[:2])
+            work.par.T = x[2]
+            c2 = work.household(p1, p2).c2
+            return np.append(work.excessdemand([p1, p2]), x[2] - tau * c2)
+
+        x0 = np.array([np.log(guess[0]), np.log(guess[1]), guess[2]])
+        with np.errstate(all='ignore'):
+            result = root(equations, x0, method='hybr', tol=tol)
+
+        # Equilibrium allocation and welfare without the kappa term
+        sol = SimpleNamespace(tau=tau, p1=np.exp(result.x[0]), p2=np.exp(result.x[1]), T=result.x[2], success=result.success)
+        work.par.T = sol.T
+        hh = work.household(sol.p1, sol.p2)
+        sol.l, sol.c1, sol.c2 = hh.l, hh.c1, hh.c2
+        sol.y2 = work.y_star_firm(sol.p2)
+        sol.utility = np.log(hh.c1**work.par.alpha * hh.c2**(1 - work.par.alpha)) - work.par.nu * hh.l**(1 + work.par.epsilon) / (1 + work.par.epsilon)
+        sol.residuals = equations(result.x)
+        sol.cache_hits, sol.cache_misses = work.cache_hits, work.cache_misses
+        self._add_cache_counts(sol)
+        return sol
+
+    # General equilibrium for a whole grid of taxes at once. The equations of policy_equilibrium are solved for
+    # all taus together with Newton's method, using a forward difference Jacobian of each tau's 3x3 system.
+    # Taus that have not converged after maxiter steps are solved one at a time with policy_equilibrium
+    def policy_equilibrium_grid(self, tau_values, guess=(1.0, 1.0, 0.0), tol=1e-10, maxiter=50):
+        tau = np.asarray(tau_values, dtype=float)
+        work = _model_with(self.par)
+        work.par.tau = tau
+
+        def equations(x):
+            p1, p2 = np.exp(x[:2])
+            work.par.T = x[2]
+            c2 = work.household(p1, p2).c2
+            return np.vstack([work.excessdemand([p1, p2]), x[2] - tau * c2])
+
+        x = np.tile(np.array([np.log(guess[0]), np.log(guess[1]), guess[2]])[:, None], (1, tau.size))
+        with np.errstate(all='ignore'):
+            F = equations(x)
+            for _ in range(maxiter):
+                error = np.max(np.abs(F), axis=0)
+                if np.all(error < tol):
+                    break
+
+                # Jacobian of every tau, shape (n, 3, 3)
+                h = 1e-7 * np.maximum(np.abs(x), 1.0)
+                J = np.empty((tau.size, 3, 3))
+                for k in range(3):
+                    dx = np.zeros_like(x)
+                    dx[k] = h[k]
+                    J[:, :, k] = ((equations(x + dx) - F) / h[k]).T
+
+                # Newton step, halved for the taus where it does not reduce the error
+                step = np.linalg.solve(J, -F.T[:, :, None])[:, :, 0].T
+                for _ in range(20):
+                    x_new = x + step
+                    F_new = equations(x_new)
+                    better = np.max(np.abs(F_new), axis=0) < error
+                    if np.all(better | (error < tol)):
+                        break
+                    step = np.where(better, step, step / 2)
+                x = np.where(better, x_new, x)
+                F = np.where(better, F_new, F)
+
+        grid = SimpleNamespace(tau=tau, p1=np.exp(x[0]), p2=np.exp(x[1]), T=x[2].copy())
+        grid.success = np.all(np.isfinite(F), axis=0) & (np.max(np.abs(F), axis=0) < tol)
+
+        # Solve the taus that did not converge on their own, warm-starting from a converged neighbour
+        for i in np.flatnonzero(~grid.success):
+            done = np.flatnonzero(grid.success)
+            k = done[np.argmin(np.abs(done - i))] if done.size > 0 else None
+            start = guess if k is None else (grid.p1[k], grid.p2[k], grid.T[k])
+            sol = self.policy_equilibrium(tau[i], start, tol)
+            grid.p1[i], grid.p2[i], grid.T[i], grid.success[i] = sol.p1, sol.p2, sol.T, sol.success
+
+        # Allocation and welfare without the kappa term
+        work.par.T = grid.T
+        hh = work.household(grid.p1, grid.p2)
+        grid.l, grid.c1, grid.c2 = hh.l, hh.c1, hh.c2
+        grid.y2 = work.y_star_firm(grid.p2)
+        grid.utility = np.log(hh.c1**work.par.alpha * hh.c2**(1 - work.par.alpha)) - work.par.nu * hh.l**(1 + work.par.epsilon) / (1 + work.par.epsilon)
+        return grid
+
+    # Equilibrium welfare on a grid of taxes and kappas. The equilibrium does not depend on kappa, so it is
+    # solved once for each tau. method='grid' solves all taus together with policy_equilibrium_grid,
+    # method='serial' solves them one at a time, warm-starting from the previous tau.
+    # Returns SWF with shape (len(tau), len(kappa))
+    def welfare_curve(self, tau_values, kappa_values=None, method='grid'):
+        tau_values = np.asarray(tau_values, dtype=float)
+        kappa_values = np.array([self.par.kappa] if kappa_values is None else kappa_values, dtype=float)
+
+        fields = ['p1', 'p2', 'T', 'utility', 'y2', 'success']
+        if method == 'grid':
+            grid = self.policy_equilibrium_grid(tau_values)
+            curve = SimpleNamespace(**{field: getattr(grid, field) for field in fields})
+        elif method == 'serial':
+            values = {field: [] for field in fields}
+            guess = (1.0, 1.0, 0.0)
+            for tau in tau_values:
+                sol = self.policy_equilibrium(tau, guess)
+                if sol.success:
+                    guess = (sol.p1, sol.p2, sol.T)
+                for field in fields:
+                    values[field].append(getattr(sol, field))
+            curve = SimpleNamespace(**{field: np.array(values[field]) for field in fields})
+        else:
+            raise ValueError(f"Unknown method: {method}")
+
+        curve.tau, curve.kappa = tau_values, kappa_values
+        curve.swf = curve.utility[:, None] - kappa_values[None, :] * curve.y2[:, None]
+        return curve
+
+    # Tax that maximizes SWF when prices and T adjust to the tax. Each candidate tau warm-starts the
+    # equilibrium from the previous one
+    def optimize_tau_ge(self, bounds=(0.0, 1.0), xatol=1e-8):
+        par = self.par
+        state = {'guess': (1.0, 1.0, 0.0)}
+
+        def objective(tau):
+            sol = self.policy_equilibrium(tau, state['guess'])
+            if not sol.success:
+                return np.inf
+            state['guess'] = (sol.p1, sol.p2, sol.T)
+            return -(sol.utility - par.kappa * sol.y2)
+
+        result = minimize_scalar(objective, bounds=bounds, method='bounded', options={'xatol': xatol})
+        sol = self.policy_equilibrium(result.x, state['guess'])
+        sol.swf = -result.fun
+        sol.nfev = result.nfev
+        return sol
+
+
+    # Solve the equilibrium and the optimal tax for each row of scenarios (a DataFrame or list of dicts
+    # with some of A, gamma, alpha, nu, epsilon, kappa). Parameters not in a scenario are taken from par.
+    # Each scenario runs on its own model on a process pool if workers is given. If path is given it must end
+    # in .csv or .parquet, and results are written to it in batches of flush_every as they finish
+    def run_scenarios(self, scenarios, path=None, workers=None, flush_every=100):
+        scenarios = pd.DataFrame(scenarios).reset_index(drop=True)
+        tasks = [(self.par, i, row) for i, row in enumerate(scenarios.to_dict('records'))]
+
+        writer = _ScenarioWriter(path, ['scenario'] + list(scenarios.columns)) if path is not None else None
+        results, batch = [], []
+
+        def collect(result):
+            self.cache_hits += result['cache_hits']
+            self.cache_misses += result['cache_misses']
+            results.append(result)
+            batch.append(result)
+            if writer is not None and len(batch) >= flush_every:
+                writer.write(batch)
+                batch.clear()
+
+        # close the generator on an error, so the scenarios still queued on the pool are cancelled
+        runs = _run_tasks(_run_scenario, tasks, workers, ordered=False)
+        try:
+            for result in runs:
+                collect(result)
+            if writer is not None and batch:
+                writer.write(batch)
+        finally:
+            runs.close()
+            if writer is not None:
+                writer.close()
+
+        return pd.DataFrame(results).sort_values('scenario').reset_index(drop=True)
+
+
+# Model with a copy of par, so the caller's parameters are not changed
+def _model_with(par):
+    model = ProductionEconomyClass()
+    model.par = copy.copy(par)
+    return model
+
+
+# Apply fn to every task, in this process or on a pool of workers processes, yielding the results.
+# With ordered=False pool results come as they finish. fn must be defined at module level so it can be sent to the pool.
+# If the caller stops early (an error, or closing the generator), the tasks not yet started are cancelled instead of waited for
+def _run_tasks(fn, tasks, workers=None, ordered=True):
+    if workers is None:
+        yield from map(fn, tasks)
+        return
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        if ordered:
+            yield from executor.map(fn, tasks)
+        else:
+            for future in as_completed([executor.submit(fn, task) for task in tasks]):
+                yield future.result()
+    except BaseException:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+
+
+# Solve one scenario on a fresh model
+def _run_scenario(task):
+    par, i, row = task
+
+    model = _model_with(par)
+    for name, value in row.items():
+        if not pd.isna(value): # missing in this scenario, keep the value from par
+            setattr(model.par, name, value)
+
+    result = {'scenario': i, **row}
+    t0 = time.perf_counter()
+    try:
+        eq = model.solve_equilibrium()
+        opt = model.optimize_tau_ge()
+        result.update(p1=eq.p1, p2=eq.p2, eq_success=eq.success,
+                      tau=opt.tau, T=opt.T, p1_tau=opt.p1, p2_tau=opt.p2, swf=opt.swf, tau_success=opt.success, error='')
+    except Exception as error:
+        result.update(error=repr(error))
+    result.update(cache_hits=model.cache_hits, cache_misses=model.cache_misses, time=time.perf_counter() - t0)
+    return result
+
+
+# Columns of a scenario result after the scenario's own columns, and their types. Failed scenarios only
+# have error, the cache counters and time, the rest are missing
+RESULT_COLUMNS = {'p1': 'float64', 'p2': 'float64', 'eq_success': 'boolean', 'tau': 'float64', 'T': 'float64',
+                  'p1_tau': 'float64', 'p2_tau': 'float64', 'swf': 'float64', 'tau_success': 'boolean',
+                  'error': 'string', 'cache_hits': 'Int64', 'cache_misses': 'Int64', 'time': 'float64'}
+
+
+# Appends batches of scenario results to a CSV or Parquet file. The columns are fixed up front from the
+# scenario columns and RESULT_COLUMNS, so every batch has the same schema whichever scenarios it holds
+class _ScenarioWriter:
+    def __init__(self, path, scenario_columns):
+        if not path.endswith(('.csv', '.parquet')):
+            raise ValueError(f"Results can only be written to .csv or .parquet, got {path}")
+
+        self.path = path
+        self.parquet = path.endswith('.parquet')
+        self.parquet_writer = None
+
+        # Import pyarrow now, so a missing install fails before any scenario is solved
+        if self.parquet:
+            import pyarrow
+            import pyarrow.parquet
+            self.pa = pyarrow
+        self.columns = list(scenario_columns) + list(RESULT_COLUMNS)
+
+        # Start from an empty file
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write(self, batch):
+        df = pd.DataFrame(batch).reindex(columns=self.columns).astype(RESULT_COLUMNS)
+
+        if self.parquet:
+            table = self.pa.Table.from_pandas(df, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = self.pa.parquet.ParquetWriter(self.path, table.schema)
+            self.parquet_writer.write_table(table.cast(self.parquet_writer.schema))
+        else:
+            df.to_csv(self.path, mode='a', header=not os.path.exists(self.path), index=False)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+# Excess demands for a block of p1 rows against all of p2, broadcasting the prices
+def _excessdemand_block(chunk):
+    par, p1_values, p2_values = chunk
+
+    model = _model_with(par)
+
+    p1 = p1_values[:, None]
+    p2 = p2_values[None, :]
+
+    # Solve the household once for the block and use it in all three markets
+    hh = model.household(p1, p2)
+    labor = model.l_star_firm(p1) + model.l_star_firm(p2) - hh.l
+    goodmarket1 = hh.c1 - model.y_star_firm(p1)
+    goodmarket2 = hh.c2 - model.y_star_firm(p2)
+    return labor, goodmarket1, goodmarket2
+
+
+# Solve for equilibrium prices from one initial guess on a copy of the model
+def _solve_from_guess(task):
+    par, guess, method, tol = task
+
+    model = _model_with(par)
+
+    with np.errstate(all='ignore'):
+        result = root(model.excessdemand, guess, jac=model.excessdemand_jac, method=method, tol=tol)
+
+    sol = SimpleNamespace(initial_guess=guess, p1=result.x[0], p2=result.x[1], nfev=result.nfev, message=result.message)
+    valid = np.all(result.x > 0)
+    sol.residuals = model.excessdemand(result.x) if valid else np.full(2, np.nan)
+    sol.residual = np.max(np.abs(sol.residuals)) if valid else np.inf
+    sol.success = bool(result.success and sol.residual < np.sqrt(tol))
+    sol.cache_hits, sol.cache_misses = model.cache_hits, model.cache_misses
+    return sol
@@ -0,0 +1,273 @@
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import os
+import time
+import numpy as np
+
+
+# PROBLEM 2
+#The career choice model, simulated for all graduates, careers and simulations at once
+class CareerChoiceClass:
+    def __init__(self):
+
+        par = self.par = SimpleNamespace()
+        par.J = 3 #number of career tracks
+        par.N = 10 #number of graduates
+        par.K = 10000 #number of simulations
+        par.F = np.arange(1, par.N + 1) #number of friends in each career for graduate i
+        par.sigma = 2 #standard deviation of the noise
+        par.v = np.array([1, 2, 3]) #value of each career track
+        par.c = 1 #switching cost
+
+    #Simulate question 1 to 3 with all K simulations in memory.
+    #rng='legacy' draws from RandomState in the same order as the notebook, so seed=80 gives the notebook's results.
+    #rng='generator' draws the shocks with _draw_chunk like simulate_stream, so simulate(seed, rng='generator') and
+    #simulate_stream(seed) use the same draws and give the same results up to rounding.
+    #The results of simulate_stream are returned under the same names, together with the arrays of every simulation
+    def simulate(self, seed=80, rng='legacy'):
+        par = self.par
+
+        #shocks with simulations on the last axis: epsilon (J, N, K), friends[i] (J, F_i, K) and noise (N, K)
+        if rng == 'legacy':
+            random = np.random.RandomState(seed) #same stream as np.random.seed(seed), without changing the global state
+            epsilon = random.normal(0, par.sigma, (par.J, par.N, par.K))
+            friends = [random.normal(0, par.sigma, (par.J, F, par.K)) for F in par.F]
+            noise = random.normal(0, par.sigma, (par.N, par.K))
+        elif rng == 'generator':
+            shocks = self._draw_chunk(np.random.default_rng(seed), par.K)
+            epsilon = shocks.epsilon.transpose(1, 2, 0)
+            friends = [eps.transpose(1, 2, 0) for eps in shocks.friends]
+            noise = shocks.noise.T
+        else:
+            raise ValueError(f"Unknown rng: {rng}")
+
+        sim = SimpleNamespace()
+
+        # Question 1: expected utility and average realized utility of each career
+        sim.expected_utilities = par.v + epsilon.mean(axis=(1, 2))
+        sim.avg_realized_utilities = (par.v[:, None, None] + epsilon).mean(axis=2).T
+
+        # Question 2: prior expected utility from the friends' draws, shape (N, J, K)
+        sim.prior_expected_utilities = np.empty((par.N, par.J, par.K))
+        for i in range(par.N):
+            sim.prior_expected_utilities[i] = par.v[:, None] + friends[i].mean(axis=1)
+        sim.average_prior_expected_utilities = sim.prior_expected_utilities.mean(axis=2)
+
+        #choose the career with the highest prior expected utility, 1-indexed as in the notebook
+        choice = sim.prior_expected_utilities.argmax(axis=1)
+        sim.chosen_careers = choice + 1
+        sim.optimal_prior_expected_utilities = np.take_along_axis(sim.prior_expected_utilities, choice[:, None, :], axis=1)[:, 0, :]
+        sim.optimal_realized_values = par.v[choice] + noise
+
+        #share choosing each career, average subjective expected utility and average realized utility
+        sim.career_proportions = self.career_shares(choice)
+        sim.average_subjective_expected_utilities = sim.optimal_prior_expected_utilities.mean(axis=1)
+        sim.average_realized_utilities = sim.optimal_realized_values.mean(axis=1)
+        sim.std_realized_utilities = sim.optimal_realized_values.std(axis=1, ddof=1)
+
+        # Question 3: staying gives the realized value, switching gives the prior minus the switching cost
+        stay = np.arange(par.J)[None, :, None] == choice[:, None, :]
+        sim.second_year_expected_utilities = np.where(stay, sim.optimal_realized_values[:, None, :], sim.prior_expected_utilities - par.c)
+
+        choice2 = sim.second_year_expected_utilities.argmax(axis=1)
+        sim.chosen_careers2 = choice2 + 1
+        sim.optimal_second_expected_utilities = np.take_along_axis(sim.second_year_expected_utilities, choice2[:, None, :], axis=1)[:, 0, :]
+
+        #realized utility in the second year, computed the same way as in the notebook
+        stay2 = np.arange(par.J)[None, :, None] == choice2[:, None, :]
+        second_year_realized_utilities = np.where(stay2, sim.optimal_realized_values[:, None, :], sim.expected_utilities[None, :, None] - par.c)
+
+        sim.career_proportions2 = self.career_shares(choice2)
+        sim.second_subjective = sim.optimal_second_expected_utilities.mean(axis=1)
+        sim.average_second_year_utilities = second_year_realized_utilities.mean(axis=2)
+        sim.average_realized_utilities2 = second_year_realized_utilities.mean(axis=(1, 2))
+
+        #percentage of simulations where the graduate switches career
+        sim.switch_count_individual = (choice != choice2).mean(axis=1) * 100
+        return sim
+
+    #Share of simulations choosing each career for each graduate, shape (N, J). choice is 0-indexed
+    def career_shares(self, choice):
+        par = self.par
+        return (choice[:, None, :] == np.arange(par.J)[None, :, None]).mean(axis=2)
+
+    #Simulate question 1 to 3 in chunks of simulations, keeping only running statistics, so memory does not grow with K.
+    #All shocks of one simulation are drawn as one row from a Generator, so the draws do not depend on chunk_size.
+    #simulate(seed, rng='generator') is the full-array computation with the same draws and gives the same results up to rounding.
+    #With workers, the K simulations are split across processes, each with its own stream from SeedSequence(seed).spawn,
+    #and the statistics are merged in worker order. Results are then identical for a given seed, number of workers and
+    #chunk_size. A different chunk_size gives the same draws but merges the statistics in other batches, which can change
+    #the last digits (around 1e-14)
+    def simulate_stream(self, seed=80, chunk_size=10000, workers=None):
+        par = self.par
+
+        if workers is None:
+            acc = self._run_stream(np.random.default_rng(seed), par.K, chunk_size)
+        else:
+            seeds = np.random.SeedSequence(seed).spawn(workers)
+            #simulations per worker, the first K % workers workers take one more
+            q, r = divmod(par.K, workers)
+            counts = [q + (i < r) for i in range(workers)]
+            tasks = [(par, child, count, chunk_size) for child, count in zip(seeds, counts)]
+            results = _map_tasks(_stream_worker, tasks, workers)
+
+            #merge the workers' statistics in a fixed order
+            acc = results[0]
+            for other in results[1:]:
+                for name, stats in vars(acc).items():
+                    stats.merge_with(getattr(other, name))
+
+        return self._finalize_stream(acc)
+
+    #Running statistics for K simulations drawn from rng in chunks
+    def _run_stream(self, rng, K, chunk_size):
+        par = self.par
+
+        #running statistics, updated chunk by chunk
+        acc = SimpleNamespace(
+            utilities=RunningStats((par.J,)), #v_j + epsilon over graduates and simulations
+            realized_utilities=RunningStats((par.N, par.J)),
+            prior_expected_utilities=RunningStats((par.N, par.J)),
+            choice=RunningStats((par.N, par.J)),
+            choice2=RunningStats((par.N, par.J)),
+            optimal_prior=RunningStats((par.N,)),
+            optimal_realized=RunningStats((par.N,)),
+            optimal_second=RunningStats((par.N,)),
+            stay2_realized=RunningStats((par.N, par.J)),
+            switch=RunningStats((par.N,)))
+
+        for k0 in range(0, K, chunk_size):
+            n = min(chunk_size, K - k0)
+            self._update_stream(acc, self._draw_chunk(rng, n))
+
+        return acc
+
+    #Time simulate_stream for 1 up to max_workers processes
+    def benchmark_workers(self, max_workers=None, seed=80, chunk_size=10000):
+        max_workers = os.cpu_count() if max_workers is None else max_workers
+
+        timings = {}
+        for workers in range(1, max_workers + 1):
+            t0 = time.perf_counter()
+            self.simulate_stream(seed=seed, chunk_size=chunk_size, workers=workers)
+            timings[workers] = time.perf_counter() - t0
+
+        return timings
+
+    #Draw the shocks for n simulations as one (n, M) block and split it into the arrays used by the model
+    def _draw_chunk(self, rng, n):
+        par = self.par
+        sizes = [par.J * par.N] + [par.J * F for F in par.F] + [par.N]
+        block = rng.normal(0, par.sigma, (n, sum(sizes)))
+        parts = np.split(block, np.cumsum(sizes)[:-1], axis=1)
+
+        shocks = SimpleNamespace()
+        shocks.epsilon = parts[0].reshape(n, par.J, par.N)
+        shocks.friends = [part.reshape(n, par.J, F) for part, F in zip(parts[1:-1], par.F)]
+        shocks.noise = parts[-1]
+        return shocks
+
+    #Run the model on one chunk of simulations and add it to the running statistics. Arrays have K last as in simulate
+    def _update_stream(self, acc, shocks):
+        par = self.par
+        careers = np.arange(par.J)[None, :, None]
+
+        # Question 1
+        utilities = par.v[None, :, None] + shocks.epsilon #(n, J, N)
+        acc.utilities.update(utilities.transpose(1, 0, 2).reshape(par.J, -1), axis=1)
+        acc.realized_utilities.update(utilities.transpose(2, 1, 0), axis=2)
+
+        # Question 2
+        prior = np.stack([par.v[:, None] + eps.mean(axis=2).T for eps in shocks.friends]) #(N, J, n)
+        choice = prior.argmax(axis=1)
+        optimal_prior = np.take_along_axis(prior, choice[:, None, :], axis=1)[:, 0, :]
+        realized = par.v[choice] + shocks.noise.T
+        acc.prior_expected_utilities.update(prior, axis=2)
+        acc.choice.update((careers == choice[:, None, :]).astype(float), axis=2)
+        acc.optimal_prior.update(optimal_prior, axis=1)
+        acc.optimal_realized.update(realized, axis=1)
+
+        # Question 3
+        stay = careers == choice[:, None, :]
+        second = np.where(stay, realized[:, None, :], prior - par.c)
+        choice2 = second.argmax(axis=1)
+        stay2 = careers == choice2[:, None, :]
+        acc.choice2.update(stay2.astype(float), axis=2)
+        acc.optimal_second.update(np.take_along_axis(second, choice2[:, None, :], axis=1)[:, 0, :], axis=1)
+        acc.stay2_realized.update(np.where(stay2, realized[:, None, :], 0.0), axis=2)
+        acc.switch.update((choice != choice2) * 100.0, axis=1)
+
+    #Turn the running statistics into the results of simulate that do not need the arrays of every simulation
+    def _finalize_stream(self, acc):
+        par = self.par
+        sim = SimpleNamespace()
+
+        sim.expected_utilities = acc.utilities.mean
+        sim.avg_realized_utilities = acc.realized_utilities.mean
+        sim.average_prior_expected_utilities = acc.prior_expected_utilities.mean
+        sim.career_proportions = acc.choice.mean
+        sim.average_subjective_expected_utilities = acc.optimal_prior.mean
+        sim.average_realized_utilities = acc.optimal_realized.mean
+        sim.std_realized_utilities = np.sqrt(acc.optimal_realized.var)
+        sim.career_proportions2 = acc.choice2.mean
+        sim.second_subjective = acc.optimal_second.mean
+
+        #the notebook uses the question 1 expected utility for careers not chosen in year 2, which is only known at the end
+        sim.average_second_year_utilities = acc.stay2_realized.mean + (1 - acc.choice2.mean) * (sim.expected_utilities[None, :] - par.c)
+        sim.average_realized_utilities2 = sim.average_second_year_utilities.mean(axis=1)
+        sim.switch_count_individual = acc.switch.mean
+        return sim
+
+
+#Running mean and variance, updated with whole batches (Welford's algorithm, merged batch-wise as in Chan et al.)
+class RunningStats:
+    def __init__(self, shape):
+        self.count = 0
+        self.mean = np.zeros(shape)
+        self.M2 = np.zeros(shape)
+
+    #Add a batch of observations along axis
+    def update(self, x, axis):
+        n = x.shape[axis]
+        if n == 0:
+            return
+        mean = x.mean(axis=axis)
+        M2 = ((x - np.expand_dims(mean, axis))**2).sum(axis=axis)
+        self.merge(n, mean, M2)
+
+    #Merge the statistics of another batch or accumulator
+    def merge(self, n, mean, M2):
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.M2 = self.M2 + M2 + delta**2 * self.count * n / total
+        self.count = total
+
+    #Merge another RunningStats into this one
+    def merge_with(self, other):
+        if other.count > 0:
+            self.merge(other.count, other.mean, other.M2)
+
+    #Sample variance
+    @property
+    def var(self):
+        return self.M2 / max(self.count - 1, 1)
+
+
+#Apply fn to every task, in this process or on a pool of workers processes.
+#fn must be defined at module level so it can be sent to the pool
+def _map_tasks(fn, tasks, workers=None):
+    if workers is None:
+        return [fn(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fn, tasks))
+
+
+#Run the streaming simulation for one worker
+def _stream_worker(task):
+    par, seed, K, chunk_size = task
+
+    model = CareerChoiceClass()
+    model.par = copy.copy(par)
+    return model._run_stream(np.random.default_rng(seed), K, chunk_size)
@@ -1,5 +1,10 @@
+from types import SimpleNamespace # Import SimpleNamespace for the results
 import numpy as np # Import numpy 
 import matplotlib.pyplot as plt # Import matplotlib.pyplot
+from scipy.spatial import cKDTree, Delaunay # Import KD-tree for nearest neighbour search and Delaunay triangulation
+import contextlib # Import contextlib to silence approx_f in the benchmark
+import io
+import time
 
 
 
@@ -7,12 +12,30 @@ import matplotlib.pyplot as plt # Import matplotlib.pyplot
 # PROBLEM 3
 #Define the algorithm in a class where it can be called and used
 class Model3:
-    def __init__(self, seed=2024): #define the seed
+    def __init__(self, seed=2024, f=None): #define the seed
         self.seed = seed #set the seed
-        self.X, self.y = self.sample(seed) #generate the sample
+        #define the function to be used in question 3. It takes a point or an (n, 2) array of points, coordinates on the last axis
+        self.f = (lambda x: x[..., 0] * x[..., 1]) if f is None else f
+        X, self.y = self.sample(seed) #generate the sample
+        self.set_points(X) #index X, evaluate f on it for question 3 and find the points A, B, C, D
+
+    #use the points X for the interpolation and find A, B, C, D for y among them. F holds f at each point of X
+    #and is evaluated if not given
+    def set_points(self, X, F=None, chunk_size=1_000_000):
+        self.X = X
+        self.index = self.build_index(X) #index over X, built once and reused by block_2
+        if F is None:
+            F = self.evaluate_f(X, chunk_size=chunk_size)
+        self.F = F
         self.A, self.B, self.C, self.D = self.block_2(self.X, self.y) #find the points A, B, C, D
-        self.f = lambda x: x[0] * x[1] #define the function to be used in question 3
-        self.F = np.array([self.f(x) for x in self.X]) #for question 3
+
+    #evaluate f over all points of X once, a block of rows at a time, into a contiguous array
+    def evaluate_f(self, X, chunk_size=1_000_000):
+        n = len(X)
+        F = np.empty(n)
+        for start in range(0, n, chunk_size):
+            F[start:start + chunk_size] = self.f(np.asarray(X[start:start + chunk_size], dtype=float))
+        return F
 
     #Define the sample to generate points based on the seed
     def sample(self, seed): #define the sample
@@ -22,30 +45,176 @@ class Model3:
         return X, y
     
     #define block 1 to find the barycentric coordinates. The denominator is the determinant
+    #works for single points and for (m, 2) arrays of triangles and points, the coordinates are on the last axis
     def block_1(self, A, B, C, y):
-        denominator = ((B[1]-C[1])*(A[0]-C[0]) + (C[0]-B[0])*(A[1]-C[1])) #determinant
-        r1 = ((B[1]-C[1])*(y[0]-C[0]) + (C[0]-B[0])*(y[1]-C[1])) / denominator #barycentric coordinate r1
-        r2 = ((C[1]-A[1])*(y[0]-C[0]) + (A[0]-C[0])*(y[1]-C[1])) / denominator #barycentric coordinate r2
+        A, B, C, y = np.asarray(A), np.asarray(B), np.asarray(C), np.asarray(y)
+        denominator = ((B[..., 1]-C[..., 1])*(A[..., 0]-C[..., 0]) + (C[..., 0]-B[..., 0])*(A[..., 1]-C[..., 1])) #determinant
+        r1 = ((B[..., 1]-C[..., 1])*(y[..., 0]-C[..., 0]) + (C[..., 0]-B[..., 0])*(y[..., 1]-C[..., 1])) / denominator #barycentric coordinate r1
+        r2 = ((C[..., 1]-A[..., 1])*(y[..., 0]-C[..., 0]) + (A[..., 0]-C[..., 0])*(y[..., 1]-C[..., 1])) / denominator #barycentric coordinate r2
         r3 = 1 - r1 - r2 #barycentric coordinate r3
         return r1, r2, r3
     
-    #define block 2 to find the minimized points A, B, C, D given the conditions in a generator process. linalg.norm is the euclidean distance
+    #build an index over the points in X, so the search for A, B, C, D does not loop over all of X:
+    #a KD-tree for nearest neighbours, and X sorted by x1 with running min and max of x2, which tells
+    #whether a quadrant around y contains any points of X.
+    #The KD-tree keeps a copy of X and its own indices, and the sort orders, sorted coordinates and running min and max
+    #take about 56 bytes per point, about 5 times the size of X in total.
+    #triangulation() adds the Delaunay triangulation on top of that
+    def build_index(self, X):
+        X = np.asarray(X, dtype=float)
+        itype = np.int32 if len(X) < 2**31 else np.int64 #smaller sort orders when possible
+        order = np.argsort(X[:, 0], kind='stable').astype(itype)
+        order2 = np.argsort(X[:, 1], kind='stable').astype(itype)
+        x2 = X[order, 1]
+        index = SimpleNamespace(tree=cKDTree(X), order=order, x1_sorted=X[order, 0], order2=order2, x2_sorted=X[order2, 1])
+        index.prefix_min = np.minimum.accumulate(x2) #min of x2 among the first i points
+        index.prefix_max = np.maximum.accumulate(x2)
+        index.suffix_min = np.minimum.accumulate(x2[::-1])[::-1] #min of x2 among point i and after
+        index.suffix_max = np.maximum.accumulate(x2[::-1])[::-1]
+        index.delaunay = None #built the first time it is needed
+        return index
+
+    #for each row of Y, whether the quadrants of A, B, C and D contain a point of X, an (m, 4) boolean array
+    def nonempty_quadrants(self, index, Y):
+        Y = np.asarray(Y, dtype=float).reshape(-1, 2)
+        n = index.x1_sorted.size
+        left = np.searchsorted(index.x1_sorted, Y[:, 0], side='left') #number of points with x1 < y1
+        right = np.searchsorted(index.x1_sorted, Y[:, 0], side='right') #first point with x1 > y1
+        has_left, has_right = left > 0, right < n
+        left, right = np.maximum(left - 1, 0), np.minimum(right, n - 1)
+        return np.stack([
+            has_right & (index.suffix_max[right] > Y[:, 1]), #A
+            has_right & (index.suffix_min[right] < Y[:, 1]), #B
+            has_left & (index.prefix_min[left] < Y[:, 1]), #C
+            has_left & (index.prefix_max[left] > Y[:, 1]), #D
+        ], axis=1)
+
+    #define block 2 to find the minimized points A, B, C, D given the conditions, using the same search as find_corners
     def block_2(self, X, y):
-        A = min((x for x in X if x[0] > y[0] and x[1] > y[1]), key=lambda x: np.linalg.norm(x - y), default=None) #point A
-        B = min((x for x in X if x[0] > y[0] and x[1] < y[1]), key=lambda x: np.linalg.norm(x - y), default=None) #point B
-        C = min((x for x in X if x[0] < y[0] and x[1] < y[1]), key=lambda x: np.linalg.norm(x - y), default=None) #point C
-        D = min((x for x in X if x[0] < y[0] and x[1] > y[1]), key=lambda x: np.linalg.norm(x - y), default=None) #point D
-        #return A, B, C, D, if None, return NaN
-        if A is None:
-            A = np.nan
-        if B is None:
-            B = np.nan
-        if C is None:
-            C = np.nan
-        if D is None:
-            D = np.nan
+        index = self.index if X is self.X else self.build_index(X) #reuse the index for the sample
+        corners = self._find_corners(X, index, y)[0]
+
+        #return A, B, C, D, if there is no point in the quadrant, return NaN
+        A, B, C, D = [X[i] if i >= 0 else np.nan for i in corners]
         return A, B, C, D
     
+    #find the indices in X of A, B, C, D for every row of Y at once, -1 if there is no point in the quadrant
+    def find_corners(self, Y, max_k=64):
+        return self._find_corners(self.X, self.index, Y, max_k)
+
+    #find_corners for the points X with the index built over them by build_index
+    def _find_corners(self, X, index, Y, max_k=64):
+        Y = np.asarray(Y, dtype=float).reshape(-1, 2)
+        m, n = len(Y), len(X)
+        corners = np.full((m, 4), -1)
+
+        #sign of x - y in each coordinate for A, B, C and D
+        signs = np.array([[1, 1], [1, -1], [-1, -1], [-1, 1]])
+        nonempty = self.nonempty_quadrants(index, Y)
+
+        #ask for the k nearest neighbours of the unresolved rows, doubling k until every non-empty quadrant is found
+        rows = np.flatnonzero(nonempty.any(axis=1))
+        k = min(8, n)
+        while rows.size > 0 and k <= max_k:
+            dist, idx = index.tree.query(Y[rows], k=k, workers=-1)
+            idx = idx.reshape(rows.size, -1)
+            diff = X[idx] - Y[rows, None, :] #(rows, k, 2)
+            for q in range(4):
+                inside = ((diff * signs[q]) > 0).all(axis=2)
+                first = inside.argmax(axis=1)
+                found = inside.any(axis=1) & (corners[rows, q] < 0)
+                corners[rows[found], q] = idx[found, first[found]]
+            rows = rows[((corners[rows] < 0) & nonempty[rows]).any(axis=1)]
+            if k == n:
+                break
+            k = min(2 * k, n)
+
+        #the few rows left have a quadrant with only far away points, typically a thin strip along an edge.
+        #Search the points on the right side of y in x1 or in x2, whichever has fewer points
+        for row in rows:
+            y = Y[row]
+            for q in range(4):
+                if corners[row, q] < 0 and nonempty[row, q]:
+                    i1 = np.searchsorted(index.x1_sorted, y[0], side='right' if signs[q, 0] > 0 else 'left')
+                    i2 = np.searchsorted(index.x2_sorted, y[1], side='right' if signs[q, 1] > 0 else 'left')
+                    side1 = index.order[i1:] if signs[q, 0] > 0 else index.order[:i1]
+                    side2 = index.order2[i2:] if signs[q, 1] > 0 else index.order2[:i2]
+                    candidates = side1 if side1.size <= side2.size else side2
+                    diff = X[candidates] - y
+                    inside = ((diff * signs[q]) > 0).all(axis=1)
+                    dist = np.einsum('ij,ij->i', diff[inside], diff[inside])
+                    corners[row, q] = candidates[inside][dist.argmin()]
+
+        return corners
+
+    #Delaunay triangulation of X, computed once and kept in the index
+    def triangulation(self):
+        if self.index.delaunay is None:
+            self.index.delaunay = Delaunay(self.X)
+        return self.index.delaunay
+
+    #order of the rows of Y along a serpentine path through a grid x grid grid over the box [lower, upper],
+    #so consecutive points are close to each other
+    def spatial_order(self, Y, lower, upper, grid=512):
+        cell = np.clip(((Y - lower) / (upper - lower) * grid).astype(int), 0, grid - 1)
+        col = np.where(cell[:, 1] % 2 == 0, cell[:, 0], grid - 1 - cell[:, 0]) #every other row is walked backwards
+        return np.argsort(cell[:, 1] * grid + col, kind='stable')
+
+    #approximate f for every row of Y with barycentric interpolation in the Delaunay triangle that contains it.
+    #NaN only outside the convex hull of X
+    def interpolate_delaunay(self, Y):
+        Y = np.asarray(Y, dtype=float).reshape(-1, 2)
+        tri = self.triangulation()
+
+        #triangle of each point. find_simplex walks from the triangle of the previous query, so the queries are
+        #visited in spatial order and the result is written back in the original order
+        order = self.spatial_order(Y, tri.min_bound, tri.max_bound)
+        simplex = np.empty(len(Y), dtype=int)
+        simplex[order] = tri.find_simplex(Y[order])
+
+        #barycentric coordinates from the stored affine transforms
+        inside = simplex >= 0
+        T = tri.transform[simplex]
+        r12 = np.einsum('mij,mj->mi', T[:, :2], Y - T[:, 2])
+        r = np.column_stack([r12, 1 - r12.sum(axis=1)])
+
+        vertices = tri.simplices[simplex]
+        approx = np.where(inside, (r * self.F[vertices]).sum(axis=1), np.nan)
+        return SimpleNamespace(method='delaunay', approx=approx, in_triangle=inside, r=r, simplex=simplex)
+
+    #approximate f for every row of the (m, 2) array Y, without printing or changing the model.
+    #Both methods return approx (NaN where y is not in a triangle) and in_triangle, so they can be swapped.
+    #method='abc' uses the ABC/CDA algorithm and also returns which triangle was used, the barycentric coordinates
+    #and the corners. method='delaunay' uses interpolate_delaunay and also returns r and simplex
+    def interpolate(self, Y, method='abc'):
+        if method == 'delaunay':
+            return self.interpolate_delaunay(Y)
+        elif method != 'abc':
+            raise ValueError(f"Unknown method: {method}")
+
+        Y = np.asarray(Y, dtype=float).reshape(-1, 2)
+        corners = self.find_corners(Y)
+
+        #corner points and their f values, NaN where the corner is missing
+        missing = corners < 0
+        P = np.where(missing[..., None], np.nan, self.X[corners]) #(m, 4, 2)
+        F = np.where(missing, np.nan, self.F[corners]) #(m, 4)
+        A, B, C, D = P[:, 0], P[:, 1], P[:, 2], P[:, 3]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r_ABC = np.stack(self.block_1(A, B, C, Y), axis=1)
+            r_CDA = np.stack(self.block_1(C, D, A, Y), axis=1)
+
+        in_ABC = ((r_ABC >= 0) & (r_ABC <= 1)).all(axis=1)
+        in_CDA = ((r_CDA >= 0) & (r_CDA <= 1)).all(axis=1)
+
+        #use ABC if y is inside it, otherwise CDA, otherwise NaN
+        f_ABC = (r_ABC * F[:, [0, 1, 2]]).sum(axis=1)
+        f_CDA = (r_CDA * F[:, [2, 3, 0]]).sum(axis=1)
+        approx = np.where(in_ABC, f_ABC, np.where(in_CDA, f_CDA, np.nan))
+
+        return SimpleNamespace(method='abc', approx=approx, in_triangle=in_ABC | in_CDA, in_triangle_ABC=in_ABC, in_triangle_CDA=in_CDA, r_ABC=r_ABC, r_CDA=r_CDA, corners=corners)
+
     #check which triangle y is in and return the barycentric coordinates as well as the point y. None if y is not in any triangle
     def check_y_in_tri(self):
         r_ABC, r_CDA = None, None #set the barycentric coordinates to None
@@ -128,12 +297,13 @@ class Model3:
 
         f_y_ABC = np.nan #set f(y) in ABC to NaN
         f_y_CDA = np.nan #set f(y) in CDA to NaN
+        F_A, F_B, F_C, F_D = self.F[self.find_corners(self.y)[0]] #look up f at A, B, C, D in F
         #if result is in ABC
         if result3["in_triangle_ABC"]: #if y is in ABC
-            f_y_ABC = result3["r_ABC"][0] * self.f(self.A) + result3["r_ABC"][1] * self.f(self.B) + result3["r_ABC"][2] * self.f(self.C) #find f(y) approx in ABC
+            f_y_ABC = result3["r_ABC"][0] * F_A + result3["r_ABC"][1] * F_B + result3["r_ABC"][2] * F_C #find f(y) approx in ABC
         # if result is in CDA
         if result3["in_triangle_CDA"]: #if y is in CDA
-            f_y_CDA = result3["r_CDA"][0] * self.f(self.C) + result3["r_CDA"][1] * self.f(self.D) + result3["r_CDA"][2] * self.f(self.A) #find f(y) approx in CDA
+            f_y_CDA = result3["r_CDA"][0] * F_C + result3["r_CDA"][1] * F_D + result3["r_CDA"][2] * F_A #find f(y) approx in CDA
        
         # Choose best approximation
         if not np.isnan(f_y_ABC): #if f(y) in ABC is not NaN
@@ -144,7 +314,7 @@ class Model3:
             f_y = np.nan #set f(y) to NaN
 
         # True value
-        true_value = self.f(self.y) 
+        true_value = self.f(np.asarray(self.y, dtype=float))
         
         #difference between the approximation and the true value
         diff_true = abs(f_y - true_value) 
@@ -176,5 +346,33 @@ class Model3:
             relative_error = diff_true / true_value
             relative_errors.append((y, relative_error))
         return relative_errors
-    
 
+    #compare approx_f (one query at a time), interpolate with ABC/CDA and interpolate with Delaunay on accuracy,
+    #NaN rate and time, for samples of n_values points and m_values queries. approx_f is only run up to loop_limit queries
+    def benchmark_interpolation(self, n_values=(50, 1000, 100000), m_values=(100, 10000, 1000000), seed=2024, loop_limit=1000):
+        rng = np.random.default_rng(seed)
+        results = []
+
+        for n in n_values:
+            model = Model3(seed)
+            model.set_points(rng.uniform(size=(n, 2)))
+
+            for m in m_values:
+                Y = rng.uniform(size=(m, 2))
+                true_value = model.f(Y)
+
+                methods = {'abc': lambda: model.interpolate(Y).approx,
+                           'delaunay': lambda: model.interpolate(Y, method='delaunay').approx}
+                if m <= loop_limit:
+                    methods['approx_f'] = lambda: np.array([r[1][0] for r in model.func_4(Y)])
+
+                for name, run in methods.items():
+                    t0 = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        approx = run()
+                    elapsed = time.perf_counter() - t0
+                    error = np.abs(approx - true_value)
+                    results.append({'method': name, 'n': n, 'm': m, 'mean_abs_error': np.nanmean(error) if np.isfinite(error).any() else np.nan,
+                                    'nan_rate': np.isnan(approx).mean(), 'time': elapsed, 'queries_per_second': m / elapsed})
+
+        return results
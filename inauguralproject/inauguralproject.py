@@ -1,6 +1,9 @@
 from types import SimpleNamespace
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import copy
 import numpy as np
-from scipy.optimize import minimize
+from scipy.optimize import minimize, brentq, bisect
 
 class MarketModel():
 
@@ -22,6 +25,10 @@ class MarketModel():
         par.w1 = par.w1A + par.w1B
         par.w2 = par.w2A + par.w2B
 
+        #Cache for the Pareto improvement sets, keyed by parameters and grid size. A mask for N=10,000 takes
+        #100 MB, so only the pareto_cache_size most recently used sets are kept
+        self.pareto_cache_size = 2
+        self._pareto_cache = OrderedDict()
 
     #Utility for A
     def utility_A(self, x1A, x2A):
@@ -33,12 +40,25 @@ class MarketModel():
         par = self.par 
         return (x1B**par.beta) * (x2B**(1-par.beta))
 
-    #Demand for A
-    def demand_A(self, p1, p2):
+    #Gradient of A's utility with respect to (x1A, x2A)
+    def grad_utility_A(self, x1A, x2A):
+        par = self.par
+        u = self.utility_A(x1A, x2A)
+        return np.array([par.alpha*u/x1A, (1 - par.alpha)*u/x2A])
+
+    #Gradient of B's utility with respect to (x1B, x2B)
+    def grad_utility_B(self, x1B, x2B):
+        par = self.par
+        u = self.utility_B(x1B, x2B)
+        return np.array([par.beta*u/x1B, (1 - par.beta)*u/x2B])
+
+    #Demand for A. p1 and p2 can be scalars or numpy arrays, p2 = 1 makes good 2 the numeraire
+    def demand_A(self, p1, p2=1):
         par = self.par
-        
-        #Set p2 as numeria
-        p2 = 1
+
+        #Convert prices to arrays so a whole price vector is evaluated at once
+        p1 = np.asarray(p1, dtype=float)
+        p2 = np.asarray(p2, dtype=float)
 
         #A's demand function
         x1A = par.alpha*((p1* par.w1A + p2* par.w2A)/p1)
@@ -47,13 +67,14 @@ class MarketModel():
         #Returnig the demand
         return x1A, x2A
 
-    #Demand for B
-    def demand_B(self, p1, p2):
+    #Demand for B. p1 and p2 can be scalars or numpy arrays, p2 = 1 makes good 2 the numeraire
+    def demand_B(self, p1, p2=1):
 
         par = self.par
 
-        #Set p2 as numeria
-        p2 = 1
+        #Convert prices to arrays so a whole price vector is evaluated at once
+        p1 = np.asarray(p1, dtype=float)
+        p2 = np.asarray(p2, dtype=float)
 
         #B's demand function
         x1B = par.beta*((p1*par.w1B + p2*par.w2B)/p1)
@@ -61,6 +82,19 @@ class MarketModel():
 
         #Returning the demand
         return x1B, x2B
+
+    #Excess demand for both goods over a price vector. Returns an array with shape (2, len(p1))
+    def excess_demand(self, p1, p2=1):
+        par = self.par
+
+        #Compute demands for the whole price vector
+        x1A, x2A = self.demand_A(p1, p2)
+        x1B, x2B = self.demand_B(p1, p2)
+
+        #Stack the errors in the market for good 1 and good 2
+        eps1 = x1A + x1B - (par.w1A + par.w1B)
+        eps2 = x2A + x2B - (par.w2A + par.w2B)
+        return np.stack(np.broadcast_arrays(eps1, eps2))
     
     #Condition for x1A and x2A
     def constraints(self, x):
@@ -74,6 +108,66 @@ class MarketModel():
 
   
 
+     ################################## Question 1 #############################################
+
+    #Compute the allocations in the N x N Edgeworth box grid that are Pareto improvements on the endowment
+    def pareto_improvement_set(self, N=75, output='bool', dtype=np.float64, chunk_rows=1000):
+        par = self.par
+
+        #Reuse the result if the parameters and the grid are unchanged
+        key = (par.alpha, par.beta, par.w1A, par.w2A, par.w1B, par.w2B, N, output, np.dtype(dtype).name)
+        if key in self._pareto_cache:
+            self._pareto_cache.move_to_end(key)
+            return self._pareto_cache[key]
+
+        #Grid for x1A and x2A, the same as np.meshgrid(x1A_vals, x2A_vals)
+        x1A_vals = np.linspace(0, par.w1, N, dtype=dtype)
+        x2A_vals = np.linspace(0, par.w2, N, dtype=dtype)
+
+        #Utility at the endowment
+        U_A_initial = self.utility_A(par.w1A, par.w2A)
+        U_B_initial = self.utility_B(par.w1B, par.w2B)
+
+        #Utility along each axis, so the grid only needs a broadcasted product
+        uA_1 = x1A_vals**par.alpha
+        uA_2 = x2A_vals**(1 - par.alpha)
+        uB_1 = (par.w1 - x1A_vals)**par.beta
+        uB_2 = (par.w2 - x2A_vals)**(1 - par.beta)
+
+        #Fill the mask a block of rows at a time, so large N does not need full utility grids
+        mask = np.empty((N, N), dtype=bool) if output == 'bool' else np.empty((N, (N + 7)//8), dtype=np.uint8)
+        for start in range(0, N, chunk_rows):
+            stop = min(start + chunk_rows, N)
+            rows = (uA_2[start:stop, None]*uA_1[None, :] >= U_A_initial) & (uB_2[start:stop, None]*uB_1[None, :] >= U_B_initial)
+            if output == 'bool':
+                mask[start:stop] = rows
+            elif output == 'bitmask':
+                mask[start:stop] = np.packbits(rows, axis=1)
+            else:
+                raise ValueError(f"Unknown output: {output}")
+
+        #Contract curve: the allocations where the marginal rates of substitution of A and B are equal
+        a = par.alpha/(1 - par.alpha)
+        b = par.beta/(1 - par.beta)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            contract_x2A = b*par.w2*x1A_vals / (a*(par.w1 - x1A_vals) + b*x1A_vals)
+        in_core = (self.utility_A(x1A_vals, contract_x2A) >= U_A_initial) & (self.utility_B(par.w1 - x1A_vals, par.w2 - contract_x2A) >= U_B_initial)
+
+        result = SimpleNamespace(x1A_vals=x1A_vals, x2A_vals=x2A_vals, mask=mask, output=output,
+                                 contract_x1A=x1A_vals, contract_x2A=contract_x2A, in_core=in_core)
+        self._pareto_cache[key] = result
+        while len(self._pareto_cache) > self.pareto_cache_size:
+            self._pareto_cache.popitem(last=False)
+        return result
+
+    #Unpack a bitmask from pareto_improvement_set into a boolean N x N array
+    def unpack_pareto_mask(self, result):
+        if result.output == 'bool':
+            return result.mask
+        N = result.x1A_vals.size
+        return np.unpackbits(result.mask, axis=1, count=N).astype(bool)
+
+
      ################################## Question 2 #############################################
 
    # Calculate errors for different values of p1
@@ -86,26 +180,13 @@ class MarketModel():
 
 
         #p1 ranges from 0.5 to 2.5 in the steps determined by 2/N
-        p1_values = [(0.5 + 2 * i / 75) for i in range(76)]
+        p1_values = 0.5 + 2 * np.arange(par.N + 1) / par.N
 
-        #Create an empty list
-        errors = []
+        #Calculates the errors for both goods for the whole price vector in one call
+        errors = self.excess_demand(p1_values, par.p2)
 
-        #Iterate over each value of p1 where p2 is numeraire
-        for p1 in p1_values:
-            x1A, x2A = self.demand_A(p1,par.p2)
-            x1B, x2B = self.demand_B(p1, par.p2)    
-            
-    
-            #Calculates the errors for both goods for each value in the pricevector. 
-            error_1 = x1A + x1B - (par.w1A + par.w1B)
-            error_2 = x2A + x2B - (par.w2A + par.w2B)
-    
-            #Creates a tupple 
-            errors.append((error_1, error_2))
-
-        # Print errors for each p1
-        return p1_values, errors
+        #Return p1 and a list of (error_1, error_2) tuples as before
+        return list(p1_values), list(zip(errors[0], errors[1]))
 
 
 
@@ -113,24 +194,53 @@ class MarketModel():
     ################################# Question 3 ####################################
 
 
-    #Check market clearing conditions.
-    def check_market_clearing(self,p1):
-        par = self.par
-
-        #Compute demands
-        x1A,x2A = self.demand_A(p1)
-        x1B,x2B = self.demand_B(p1)
+    #Check market clearing conditions. Works for a single p1 or a numpy array of prices
+    def check_market_clearing(self, p1, p2=1):
 
         #Calculate errors
-        eps1 = x1A - par.w1A + x1B - par.w1B
-        eps2 = x2A - par.w2A + x2B - par.w2B
+        eps1, eps2 = self.excess_demand(p1, p2)
 
         #Return the distance using the Pythagorean theorem
         return np.sqrt(eps1**2 + eps2**2)
     
-    #Caulculate excess demand
-    def market_clearing_condition(self, p1):
-        return self.demand_A(p1) + self.demand_B(p1) - 1
+    #Caulculate excess demand for good 1
+    def market_clearing_condition(self, p1, p2=1):
+        return self.excess_demand(p1, p2)[0]
+
+    #Find the market clearing price p1 (p2 is numeraire)
+    def equilibrium_price(self, p2=1, method='closed_form', bracket=(0.5, 2.5), tol=1e-12, maxiter=100):
+        par = self.par
+
+        sol = SimpleNamespace(method=method, p2=p2, iterations=0)
+
+        #Cobb-Douglas closed form: the value of good 1 demanded equals the value of good 1 in the economy
+        if method == 'closed_form':
+            sol.p1 = p2 * (par.alpha*par.w2A + par.beta*par.w2B) / ((1 - par.alpha)*par.w1A + (1 - par.beta)*par.w1B)
+            sol.converged = True
+
+        #Bracketed root finding on the market clearing condition for good 1
+        elif method in ('brentq', 'bisect'):
+            f = lambda p1: self.market_clearing_condition(p1, p2)
+
+            #Widen the bracket until excess demand changes sign
+            low, high = bracket
+            while f(low) < 0 and low > 1e-10:
+                low = low / 2
+            while f(high) > 0 and high < 1e10:
+                high = high * 2
+
+            solver = brentq if method == 'brentq' else bisect
+            sol.p1, res = solver(f, low, high, xtol=tol, maxiter=maxiter, full_output=True)
+            sol.iterations = res.iterations
+            sol.converged = res.converged
+
+        else:
+            raise ValueError(f"Unknown method: {method}")
+
+        #Report the errors in both markets at the solution
+        sol.residuals = self.excess_demand(sol.p1, p2)
+        sol.residual = self.check_market_clearing(sol.p1, p2)
+        return sol
     
 
     ######################### Question 4 #############################
@@ -144,6 +254,11 @@ class MarketModel():
     def objective_5(self, x):
         x1A, x2A = x
         return -self.utility_A(x1A, x2A)  # Pass arguments unpacked
+
+    #Gradient of the objective in question 5
+    def objective_5_grad(self, x):
+        x1A, x2A = x
+        return -self.grad_utility_A(x1A, x2A)
     
 
 
@@ -154,6 +269,11 @@ class MarketModel():
         x1B = 1 - x1A
         x2B = 1 - x2A
         return self.utility_B(x1B, x2B) - self.utility_B(self.par.w1B, self.par.w2B)
+
+    #Jacobian of the constraint. B's goods are 1 - x, hence the minus sign
+    def constraints_jac(self, x):
+        x1A, x2A = x
+        return -self.grad_utility_B(1 - x1A, 1 - x2A)
     
 
     #Define aggregate utility for consumer A and B
@@ -162,6 +282,11 @@ class MarketModel():
         x1B = 1 - x1A
         x2B = 1 - x2A
         return self.utility_A(x1A, x2A) + self.utility_B(x1B, x2B)
+
+    #Gradient of the aggregate utility
+    def aggregate_utility_grad(self, x):
+        x1A, x2A = x
+        return self.grad_utility_A(x1A, x2A) - self.grad_utility_B(1 - x1A, 1 - x2A)
     
 
 
@@ -172,9 +297,205 @@ class MarketModel():
         x1A = x[0]
         x2A = x[1]
         return -(self.utility_A(x1A, x2A) + self.utility_B(1 - x1A, 1 - x2A))
+
+    #Gradient of the objective in question 8
+    def objective_8_grad(self, x):
+        return -self.aggregate_utility_grad(x)
+
     #Define the utility for Consumer A
     def utility_A_8(self, x1A, x2A):
         return x1A**self.par.alpha * x2A**(1 - self.par.alpha)
     #Define the utility for B
     def utility_B_8(self, x1B, x2B):
-        return x1B**self.par.beta * x2B**(1 - self.par.beta)
\ No newline at end of file
+        return x1B**self.par.beta * x2B**(1 - self.par.beta)
+
+    #Solve the allocation problems in question 5, 6 and 8 with SLSQP, using the analytic gradients if jac is True
+    def solve_allocation(self, question, x0=(0.5, 0.5), jac=True):
+        par = self.par
+
+        #Keep the bounds slightly inside the box, the gradients are infinite where a consumer has zero of a good
+        bounds = [(1e-8, 1 - 1e-8), (1e-8, 1 - 1e-8)]
+
+        #Question 5: A chooses the allocation subject to B not being worse off than at the endowment
+        if question == 5:
+            fun, grad = self.objective_5, self.objective_5_grad
+            cons = [{'type': 'ineq', 'fun': self.constraints, 'jac': self.constraints_jac}]
+
+        #Question 6: the utilitarian planner maximizes aggregate utility
+        elif question == 6:
+            fun, grad = lambda x: -self.aggregate_utility(x), self.objective_8_grad
+            cons = []
+
+        #Question 8: aggregate utility subject to both consumers being at least as well off as at the endowment
+        elif question == 8:
+            fun, grad = self.objective_8, self.objective_8_grad
+            cons = [{'type': 'ineq', 'fun': self.constraints, 'jac': self.constraints_jac},
+                    {'type': 'ineq', 'fun': lambda x: self.utility_A(x[0], x[1]) - self.utility_A(par.w1A, par.w2A),
+                     'jac': lambda x: self.grad_utility_A(x[0], x[1])}]
+
+        else:
+            raise ValueError(f"Unknown question: {question}")
+
+        #Without jac, drop the analytic Jacobians so scipy uses finite differences
+        if not jac:
+            grad = None
+            cons = [{'type': c['type'], 'fun': c['fun']} for c in cons]
+
+        return minimize(fun, x0, jac=grad, method='SLSQP', bounds=bounds, constraints=cons)
+
+    #Compare the number of objective evaluations with and without analytic gradients
+    def benchmark_gradients(self, questions=(5, 6, 8), x0=(0.5, 0.5)):
+        results = {}
+
+        for question in questions:
+            #Count every call to the utility functions in each run
+            counts = {}
+            for jac in (False, True):
+                calls = [0]
+                utility_A, utility_B = self.utility_A, self.utility_B
+
+                def counted_A(x1A, x2A):
+                    calls[0] += 1
+                    return utility_A(x1A, x2A)
+
+                def counted_B(x1B, x2B):
+                    calls[0] += 1
+                    return utility_B(x1B, x2B)
+
+                self.utility_A, self.utility_B = counted_A, counted_B
+                try:
+                    res = self.solve_allocation(question, x0=x0, jac=jac)
+                finally:
+                    del self.utility_A, self.utility_B
+
+                counts['jac' if jac else 'finite_diff'] = {'nfev': res.nfev, 'njev': res.njev, 'utility_calls': calls[0], 'x': res.x}
+            results[question] = counts
+
+        return results
+
+    #Solve the market equilibrium for many endowments (w1A, w2A) at once. B owns the rest of the goods
+    def solve_endowments(self, w1A, w2A, p2=1, method='closed_form', workers=None, chunksize=1000):
+        par = self.par
+
+        w1A = np.asarray(w1A, dtype=float)
+        w2A = np.asarray(w2A, dtype=float)
+        w1B = par.w1 - w1A
+        w2B = par.w2 - w2A
+
+        #Cobb-Douglas closed form for the whole set of endowments in one vectorized pass
+        if method == 'closed_form':
+            p1 = p2 * (par.alpha*w2A + par.beta*w2B) / ((1 - par.alpha)*w1A + (1 - par.beta)*w1B)
+
+        #Root finding for each endowment, optionally spread over a process pool
+        else:
+            tasks = [(par, a, b, p2, method) for a, b in zip(w1A.ravel(), w2A.ravel())]
+            p1 = np.array(_map_tasks(_solve_endowment, tasks, workers, chunksize)).reshape(w1A.shape)
+
+        #Allocations from the demand functions at the equilibrium prices
+        incomeA = p1*w1A + p2*w2A
+        incomeB = p1*w1B + p2*w2B
+        sol = SimpleNamespace(p1=p1, p2=p2)
+        sol.x1A = par.alpha*incomeA/p1
+        sol.x2A = (1 - par.alpha)*incomeA/p2
+        sol.x1B = par.beta*incomeB/p1
+        sol.x2B = (1 - par.beta)*incomeB/p2
+        return sol
+
+
+#Apply fn to every task, in this process or on a pool of workers processes.
+#fn must be defined at module level so it can be sent to the pool
+def _map_tasks(fn, tasks, workers=None, chunksize=1):
+    if workers is None:
+        return [fn(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fn, tasks, chunksize=chunksize))
+
+
+#Solve the equilibrium price for one endowment on a copy of the model
+def _solve_endowment(task):
+    par, w1A, w2A, p2, method = task
+
+    model = MarketModel()
+    model.par = copy.copy(par)
+    model.par.w1A = w1A
+    model.par.w2A = w2A
+    model.par.w1B = par.w1 - w1A
+    model.par.w2B = par.w2 - w2A
+
+    return model.equilibrium_price(p2=p2, method=method).p1
+
+
+class ExchangeEconomy():
+
+    #N consumers with Cobb-Douglas preferences over M goods. alpha and W are (N, M) arrays, each row of alpha sums to one
+    def __init__(self, alpha, W):
+
+        par = self.par = SimpleNamespace()
+
+        #Store preferences and endowments as contiguous float arrays
+        par.alpha = np.ascontiguousarray(alpha, dtype=float)
+        par.W = np.ascontiguousarray(W, dtype=float)
+        par.N, par.M = par.W.shape
+
+        #Total endowment of each good
+        par.w = par.W.sum(axis=0)
+
+    #Build the two consumer, two good economy from a MarketModel
+    @classmethod
+    def from_market_model(cls, model):
+        par = model.par
+        alpha = [[par.alpha, 1 - par.alpha], [par.beta, 1 - par.beta]]
+        W = [[par.w1A, par.w2A], [par.w1B, par.w2B]]
+        return cls(alpha, W)
+
+    #Income of every consumer at prices p
+    def income(self, p):
+        return self.par.W @ np.asarray(p, dtype=float)
+
+    #Demand of every consumer for every good, an (N, M) array
+    def demand(self, p):
+        p = np.asarray(p, dtype=float)
+        return self.par.alpha * self.income(p)[:, None] / p[None, :]
+
+    #Aggregate demand as one matrix product
+    def aggregate_demand(self, p):
+        p = np.asarray(p, dtype=float)
+        return self.par.alpha.T @ self.income(p) / p
+
+    #Excess demand for every good
+    def excess_demand(self, p):
+        return self.aggregate_demand(p) - self.par.w
+
+    #Find equilibrium prices with the last good as numeraire
+    def equilibrium(self, method='newton', p0=None, step=0.5, tol=1e-12, maxiter=10000):
+        par = self.par
+
+        sol = SimpleNamespace(method=method, iterations=0, converged=False)
+
+        #Value of excess demand, p*z(p) = (alpha' W - diag(w)) p, is linear in prices. Newton converges in one step
+        if method == 'newton':
+            J = par.alpha.T @ par.W - np.diag(par.w)
+            p = np.ones(par.M)
+            p[:-1] = np.linalg.solve(J[:-1, :-1], -J[:-1, -1])
+            sol.iterations = 1
+
+        #Tatonnement: raise the price of goods in excess demand, lower it for goods in excess supply
+        elif method == 'tatonnement':
+            p = np.ones(par.M) if p0 is None else np.array(p0, dtype=float)
+            z = self.excess_demand(p)
+            it = 0
+            while it < maxiter and np.max(np.abs(z)) >= tol:
+                p = p*(1 + step*z/par.w)
+                p = p/p[-1]
+                z = self.excess_demand(p)
+                it += 1
+            sol.iterations = it
+
+        else:
+            raise ValueError(f"Unknown method: {method}")
+
+        sol.p = p
+        sol.x = self.demand(p)
+        sol.excess = self.excess_demand(p)
+        sol.converged = bool(np.max(np.abs(sol.excess)) < tol)
+        return sol
@@ -1,29 +1,236 @@
 from scipy import optimize
+import builtins
+import hashlib
+import inspect
+import os
 import numpy as np
 import sympy as sm
 import matplotlib.pyplot as plt
 from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
 from scipy.optimize import root
-from scipy.optimize import minimize 
+from scipy.optimize import minimize
 
 
 class MarketModel():
 
-        # Define the best response functions using numerical optimization
-        def best_response1(q2, A, alpha, c):
-            q1 = (A - q2 - alpha * c) / 2
-            return q1
+    # Define the best response functions using numerical optimization
+    def best_response1(self, q2, A, alpha, c):
+        q1 = (A - q2 - alpha * c) / 2
+        return q1
 
-        def best_response2(A, q1, alpha, c):
-            q2 = (A - q1 - alpha * c) / 2
-            return q2
+    def best_response2(self, A, q1, alpha, c):
+        q2 = (A - q1 - alpha * c) / 2
+        return q2
 
-        # Define the function to find the equilibrium by minimizing the squared differences
-        def find_equilibrium(x, A, alpha, c):
-            q1, q2 = x
-            br1 = best_response1(q2, A, alpha, c)
-            br2 = best_response2(q1, A, alpha, c)
-            return (q1 - br1) ** 2 + (q2 - br2) ** 2
-            
-    
+    # Define the function to find the equilibrium by minimizing the squared differences
+    def find_equilibrium(self, x, A, alpha, c):
+        q1, q2 = x
+        br1 = self.best_response1(q2, A, alpha, c)
+        br2 = self.best_response2(A, q1, alpha, c)
+        return (q1 - br1) ** 2 + (q2 - br2) ** 2
 
+    # Cournot equilibrium for N firms with marginal costs c, demand Q = A - alpha*P.
+    # A and alpha can be arrays for a grid of markets, c then has shape (..., N) with the firms on the last axis
+    def cournot_equilibrium(self, A, alpha, c):
+        A = np.asarray(A, dtype=float)[..., None]
+        alpha = np.asarray(alpha, dtype=float)[..., None]
+        c = np.asarray(c, dtype=float)
+        A, alpha, c = np.broadcast_arrays(A, alpha, c)
+
+        # The best responses q_i = (A - Q_-i - alpha*c_i)/2 form the linear system (I + 11')q = A - alpha*c,
+        # which is solved in closed form: Q = (n*A - alpha*sum(c))/(n + 1) and q_i = A - alpha*c_i - Q.
+        # Firms that would produce a negative quantity are dropped and the system is solved again for the rest
+        active = np.ones(c.shape, dtype=bool)
+        for _ in range(c.shape[-1]):
+            n = active.sum(axis=-1, keepdims=True)
+            Q = (n * A[..., :1] - (alpha * c * active).sum(axis=-1, keepdims=True)) / (n + 1)
+            q = np.where(active, A - alpha * c - Q, 0.0)
+            if not (q < 0).any():
+                break
+            active = active & (q > 0)
+        q = np.maximum(q, 0.0)
+
+        # Market outcome
+        eq = SimpleNamespace(q=q)
+        eq.Q = q.sum(axis=-1)
+        eq.P = (A[..., 0] - eq.Q) / alpha[..., 0]
+        eq.profits = (eq.P[..., None] - c) * q
+        return eq
+
+    # Best response dynamics for N firms with marginal costs c. Yields the aggregates of each period,
+    # so long runs can be streamed without storing the history of every firm.
+    # mode is 'simultaneous' (all firms respond to last period) or 'sequential' (firms respond in turn).
+    # With weight < 1 firms only move part of the way to their best response, which is needed for
+    # simultaneous updates to converge with 3 or more firms.
+    # Each firm in 'sequential' needs the total quantity after the previous firm has moved, so it is a Python loop
+    # over the firms: a period with thousands of firms takes milliseconds, over 100 times longer than 'simultaneous'
+    def iterate_best_response(self, A, alpha, c, q0=None, T=1000, mode='simultaneous', weight=1.0, tol=1e-10):
+        c = np.asarray(c, dtype=float)
+        q = np.zeros(c.size) if q0 is None else np.array(q0, dtype=float)
+        Q = q.sum()
+
+        for t in range(T):
+            if mode == 'simultaneous':
+                br = np.maximum((A - (Q - q) - alpha * c) / 2, 0.0)
+                q_new = (1 - weight) * q + weight * br
+                change = np.max(np.abs(q_new - q))
+                q = q_new
+                Q = q.sum()
+            elif mode == 'sequential':
+                change = 0.0
+                for i in range(c.size):
+                    br = max((A - (Q - q[i]) - alpha * c[i]) / 2, 0.0)
+                    qi = (1 - weight) * q[i] + weight * br
+                    change = max(change, abs(qi - q[i]))
+                    Q += qi - q[i]
+                    q[i] = qi
+            else:
+                raise ValueError(f"Unknown mode: {mode}")
+
+            # Aggregates for this period
+            P = (A - Q) / alpha
+            yield SimpleNamespace(t=t, Q=Q, P=P, profit=np.sum((P - c) * q), active=np.count_nonzero(q), change=change, q=q)
+
+            # Stop when no firm changes its quantity by more than tol
+            if change < tol:
+                break
+
+    # Run the best response dynamics and return the final period. If record is True the aggregates
+    # (not the quantities of each firm) are stored for every period
+    def simulate_best_response(self, A, alpha, c, q0=None, T=1000, mode='simultaneous', weight=1.0, tol=1e-10, record=False):
+        history = {'Q': [], 'P': [], 'profit': [], 'change': []}
+
+        # Starting point, returned as it is if no period is run (T=0)
+        c = np.asarray(c, dtype=float)
+        q = np.zeros(c.size) if q0 is None else np.array(q0, dtype=float)
+        P = (A - q.sum()) / alpha
+        stats = SimpleNamespace(t=-1, Q=q.sum(), P=P, profit=np.sum((P - c) * q), active=np.count_nonzero(q), change=np.inf, q=q)
+
+        for stats in self.iterate_best_response(A, alpha, c, q0=q0, T=T, mode=mode, weight=weight, tol=tol):
+            if record:
+                for key in history:
+                    history[key].append(stats.__dict__[key])
+
+        stats.converged = stats.change < tol
+        stats.q = stats.q.copy()
+        if record:
+            stats.history = {key: np.array(values) for key, values in history.items()}
+        return stats
+
+    # Compare monopoly, Cournot and Bertrand over the grid spanned by A_values, alpha_values and c_values.
+    # N is the number of Cournot firms. The grid is evaluated in chunks, optionally on a process pool
+    def sweep(self, A_values, alpha_values, c_values, N=2, chunksize=100_000, workers=None, as_frame=True):
+        A_grid, alpha_grid, c_grid = np.meshgrid(A_values, alpha_values, c_values, indexing='ij')
+        A_grid, alpha_grid, c_grid = A_grid.ravel(), alpha_grid.ravel(), c_grid.ravel()
+
+        # Split the grid into chunks
+        chunks = [(A_grid[i:i + chunksize], alpha_grid[i:i + chunksize], c_grid[i:i + chunksize], N)
+                  for i in range(0, A_grid.size, chunksize)]
+
+        results = _map_tasks(_market_structures, chunks, workers)
+
+        # Stack the chunks, each entry has shape (3, grid size) for monopoly, Cournot and Bertrand
+        out = SimpleNamespace(A=A_grid, alpha=alpha_grid, c=c_grid, structures=('monopoly', 'cournot', 'bertrand'))
+        out.Q, out.P, out.profit = [np.concatenate([r[k] for r in results], axis=1) for k in range(3)]
+
+        if not as_frame:
+            return out
+
+        # Tidy DataFrame with one row per market structure and parameter point
+        n = A_grid.size
+        return pd.DataFrame({
+            'A': np.tile(A_grid, 3),
+            'alpha': np.tile(alpha_grid, 3),
+            'c': np.tile(c_grid, 3),
+            'structure': pd.Categorical(np.repeat(out.structures, n), categories=out.structures),
+            'Q': out.Q.ravel(),
+            'P': out.P.ravel(),
+            'profit': out.profit.ravel(),
+        })
+
+
+# Apply fn to every task, in this process or on a pool of workers processes.
+# fn must be defined at module level so it can be sent to the pool
+def _map_tasks(fn, tasks, workers=None):
+    if workers is None:
+        return [fn(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fn, tasks))
+
+
+# Closed form outcomes for monopoly, N firm Cournot and Bertrand with demand Q = A - alpha*P
+def _market_structures(chunk):
+    A, alpha, c, N = chunk
+
+    # Quantity produced when the price equals marginal cost, zero if the market is not served
+    Q_comp = np.maximum(A - alpha * c, 0.0)
+
+    # Monopoly: half of the competitive quantity. Cournot: N/(N+1) of it. Bertrand: price equals marginal cost
+    Q = np.stack([Q_comp / 2, N * Q_comp / (N + 1), Q_comp])
+    P = (A - Q) / alpha
+    P[2] = np.where(Q_comp > 0, c, A / alpha)
+    profit = (P - c) * Q
+    return Q, P, profit
+
+
+# Folder for the compiled sympy kernels
+KERNEL_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__kernelcache__')
+
+# Kernels already loaded in this session
+_kernels = {}
+
+
+# Turn a sympy expression (or list of expressions) into a numpy function of args, cached on disk.
+# If solve_for is given, the first order condition of expr with respect to solve_for is solved first,
+# after substituting subs. This is how the best response functions are derived in the notebook
+def compile_kernel(expr, args, solve_for=None, subs=None, cache_dir=None):
+    cache_dir = KERNEL_CACHE_DIR if cache_dir is None else cache_dir
+    subs = {} if subs is None else subs
+
+    # Key on the problem, not the solution, so the symbolic solving can be skipped on a hit
+    problem = sm.srepr((expr, tuple(args), solve_for, tuple(sorted(subs.items(), key=str))))
+    key = hashlib.sha256(problem.encode()).hexdigest()[:16]
+
+    if key in _kernels:
+        return _kernels[key]
+
+    path = os.path.join(cache_dir, f'kernel_{key}.py')
+    if os.path.exists(path):
+        with open(path) as file:
+            source = file.read()
+    else:
+        # Derive the first order condition and solve it for solve_for
+        if solve_for is not None:
+            foc = sm.diff(expr, solve_for).subs(subs)
+            expr = sm.solve(foc, solve_for)[0]
+
+        # Generate the numpy source code
+        kernel = sm.lambdify(args, expr, 'numpy')
+        source = inspect.getsource(kernel)
+
+        # lambdify also imports some helpers outside numpy for the expression (reduce for Max, for example).
+        # Write those imports into the file, so a cached kernel can run without lambdify
+        imports = []
+        for name in kernel.__code__.co_names:
+            module = getattr(kernel.__globals__.get(name), '__module__', None)
+            if module is not None and module.split('.')[0] not in ('numpy', 'builtins'):
+                imports.append(f'from {module} import {name}\n')
+        source = ''.join(imports) + source
+
+        # Store it, writing to a temporary file first so a pool worker reading the kernel never sees half a file
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as file:
+            file.write(source)
+        os.replace(tmp, path)
+
+    # Execute the generated code in a namespace with numpy, builtins and range, like lambdify does
+    namespace = {}
+    exec('from numpy import *', namespace)
+    namespace.update({'numpy': np, 'builtins': builtins, 'range': range})
+    exec(source, namespace)
+
+    kernel = _kernels[key] = namespace['_lambdifygenerated']
+    return kernel